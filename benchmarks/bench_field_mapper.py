@@ -0,0 +1,257 @@
+"""
+Micro-benchmark for the attribute/event field mapping of MISPHTTPClient.
+
+Compares the previous per-item mapping implementation with the compiled FieldMapper
+and verifies that both produce the same output.
+
+Usage:
+    python benchmarks/bench_field_mapper.py [--items 100000] [--prefix misp_]
+
+Requires the python dependencies of the app (requests, solnlib, splunk-sdk).
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from functools import reduce
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'package', 'bin'))
+
+from misp_client import MISPHTTPClient
+
+
+def legacy_map_attribute(attribute_dict, prefix="misp_"):
+    mapping = {
+        'category': 'category',
+        'comment': 'comment',
+        'distribution': 'attribute_distribution',
+        'event_id': 'event_id',
+        'event_uuid': 'event_uuid',
+        'id': 'attribute_id',
+        'object_id': 'object_id',
+        'object_relation': 'object_relation',
+        'sharing_group_id': 'sharing_group_id',
+        'timestamp': 'timestamp',
+        'to_ids': 'to_ids',
+        'type': 'type',
+        'value': 'value',
+        'Event.distribution': 'event_distribution',
+        'Event.id': 'event_id',
+        'Event.info': 'event_info',
+        'Event.org_id': 'org_id',
+        'Event.orgc_id': 'orgc_id',
+        'Event.uuid': 'event_uuid',
+        'deleted': 'deleted',
+        'first_seen': 'first_seen',
+        'Event.Orgc.name': 'event_orgc_name',
+        'Event.Orgc.uuid': 'event_orgc_uuid',
+        'Event.analysis': 'event_analysis',
+        'Event.date': 'event_date',
+        'Event.timestamp': 'event_timestamp',
+        'Event.publish_timestamp': 'event_publish_timestamp',
+        'Event.published': 'event_published',
+        'Event.threat_level_id': 'event_threat_level'
+    }
+
+    attribute = dict()
+    for key, value in mapping.items():
+        try:
+            attribute[f'{prefix}{value}'] = reduce(lambda acc,i: acc[i], key.split('.'), attribute_dict)
+        except:
+            pass
+
+    if 'Tag' in attribute_dict:
+        if isinstance(attribute_dict['Tag'], list):
+            attribute[f'{prefix}tag'] = list()
+            for tag in attribute_dict.get('Tag', []):
+                attribute[f'{prefix}tag'].append(tag['name'].strip())
+        elif isinstance(attribute_dict['Tag'], dict):
+            attribute[f'{prefix}tag'] = attribute_dict['Tag']['name'].strip()
+
+    hash_types = ['impfuzzy', 'imphash', 'md5', 'pehash', 'sha1', 'sha224', 'sha256', 'sha3-224', 'sha3-224', 'sha3-384', 'sha3-512', 'sha384', 'sha512', 'sha512/224', 'sha512/224', 'ssdeep', 'tlsh', 'vhash']
+    ip_types = ['ip', 'ip-dst', 'ip-src', ]
+    email_types = ['dns-soa-email', 'email', 'email-dst', 'email-src', 'email-replay-to', 'target-email', 'whois-registrant-email']
+    values = attribute_dict['value'].split('|')
+    types = attribute_dict['type'].split('|')
+    for value, misp_type in zip(values, types):
+        if misp_type in hash_types:
+            attribute[f'{prefix}hash'] = value
+        if misp_type in ip_types:
+            attribute[f'{prefix}ip'] = value
+        if misp_type in email_types:
+            attribute[f'{prefix}email'] = value
+        misp_type = misp_type.replace('-', '_')
+        attribute[f'{prefix}{misp_type}'] = value
+
+    return attribute
+
+
+def legacy_map_event(event_dict, prefix="misp_"):
+    mapping = {
+            'id': 'event_id',
+            'orgc_id': 'orgc_id',
+            'org_id': 'org_id',
+            'date': 'event_date',
+            'threat_level_id': 'event_threat_level',
+            'info': 'event_info',
+            'published': 'event_published',
+            'uuid': 'event_uuid',
+            'attribute_count': 'event_attribute_count',
+            'analysis': 'event_analysis',
+            'timestamp': 'event_timestamp',
+            'distribution': 'event_distribution',
+            'publish_timestamp': 'event_publish_timestamp',
+            'sharing_group_id': 'misp_sharing_group_id',
+            'Org.name': 'event_org_name',
+            'Org.uuid': 'event_org_uuid',
+            'Orgc.name': 'event_orgc_name',
+            'Orgc.uuid': 'event_orgc_uuid',
+            'Galaxy': 'event_galaxy'
+        }
+
+    event = dict()
+    for key, value in mapping.items():
+        try:
+            event[f'{prefix}{value}'] = reduce(lambda acc,i: acc[i], key.split('.'), event_dict)
+        except:
+            pass
+
+    if 'Tag' in event_dict:
+        if isinstance(event_dict['Tag'], list):
+            event[f'{prefix}tag'] = list()
+            for tag in event_dict.get('Tag', []):
+                event[f'{prefix}tag'].append(tag['name'].strip())
+        elif isinstance(event_dict['Tag'], dict):
+            event[f'{prefix}tag'] = event_dict['Tag']['name'].strip()
+
+    return event
+
+
+SAMPLE_TYPES = [
+    ('ip-dst', '198.51.100.{}'),
+    ('domain', 'host{}.example.com'),
+    ('domain|ip', 'host{}.example.com|203.0.113.7'),
+    ('md5', '{:032x}'),
+    ('sha256', '{:064x}'),
+    ('filename|sha1', 'sample{}.exe|{:040x}'),
+    ('email-src', 'user{}@example.com'),
+    ('url', 'https://example.com/path/{}?q=a|b'),
+]
+
+
+def sample_attribute(i, rnd, include_context, tag_count):
+    misp_type, template = SAMPLE_TYPES[i % len(SAMPLE_TYPES)]
+    attribute = {
+        'id': str(i),
+        'event_id': str(i // 100),
+        'object_id': '0',
+        'object_relation': None,
+        'category': 'Network activity',
+        'type': misp_type,
+        'to_ids': True,
+        'uuid': f'{i:032x}',
+        'timestamp': str(1700000000 + i),
+        'distribution': '5',
+        'sharing_group_id': '0',
+        'comment': '',
+        'deleted': False,
+        'disable_correlation': False,
+        'first_seen': None,
+        'last_seen': None,
+        'value': template.format(i, i),
+        'event_uuid': f'{i // 100:032x}',
+    }
+    if include_context:
+        attribute['Event'] = {
+            'org_id': '1',
+            'distribution': '1',
+            'id': str(i // 100),
+            'info': f'Event {i // 100}',
+            'orgc_id': '2',
+            'uuid': f'{i // 100:032x}',
+            'analysis': '2',
+            'date': '2024-01-01',
+            'timestamp': '1700000000',
+            'publish_timestamp': '1700000100',
+            'published': True,
+            'threat_level_id': '2',
+            'Orgc': {'id': '2', 'name': 'CIRCL', 'uuid': f'{2:032x}'},
+        }
+    if tag_count:
+        attribute['Tag'] = [{'id': str(t), 'name': f' tlp:green{t} ', 'colour': '#ffffff'} for t in range(rnd.randint(0, tag_count))]
+    return attribute
+
+
+def sample_event(i, rnd, tag_count):
+    event = {
+        'id': str(i),
+        'orgc_id': '2',
+        'org_id': '1',
+        'date': '2024-01-01',
+        'threat_level_id': '2',
+        'info': f'Event {i}',
+        'published': True,
+        'uuid': f'{i:032x}',
+        'attribute_count': '42',
+        'analysis': '2',
+        'timestamp': str(1700000000 + i),
+        'distribution': '1',
+        'publish_timestamp': str(1700000100 + i),
+        'sharing_group_id': '0',
+        'Org': {'id': '1', 'name': 'ORG', 'uuid': f'{1:032x}'},
+        'Orgc': {'id': '2', 'name': 'CIRCL', 'uuid': f'{2:032x}'},
+    }
+    if tag_count:
+        event['Tag'] = [{'id': str(t), 'name': f'tlp:green{t}'} for t in range(rnd.randint(0, tag_count))]
+    return event
+
+
+def items_per_second(function, items, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            function(item)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(items) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--prefix', default='misp_')
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    attribute_mapper = MISPHTTPClient.get_attribute_mapper(args.prefix)
+    event_mapper = MISPHTTPClient.get_event_mapper(args.prefix)
+
+    scenarios = [
+        ('attributes (input, no context)', [sample_attribute(i, rnd, False, 3) for i in range(args.items)],
+            lambda x: legacy_map_attribute(x, args.prefix), attribute_mapper.map),
+        ('attributes (search, with context)', [sample_attribute(i, rnd, True, 3) for i in range(args.items)],
+            lambda x: legacy_map_attribute(x, args.prefix), attribute_mapper.map),
+        ('attributes (expanded tag)', [dict(sample_attribute(i, rnd, False, 0), Tag={'name': 'tlp:amber'}) for i in range(args.items)],
+            lambda x: legacy_map_attribute(x, args.prefix), attribute_mapper.map),
+        ('events', [sample_event(i, rnd, 5) for i in range(args.items)],
+            lambda x: legacy_map_event(x, args.prefix), event_mapper.map),
+    ]
+
+    print(f"{'scenario':<36} {'before items/s':>15} {'after items/s':>15} {'speedup':>8}")
+    for name, items, before, after in scenarios:
+        for item in items:
+            expected = before(item)
+            actual = after(item)
+            if expected != actual or list(expected) != list(actual):
+                raise AssertionError(f"Mapping differs for {name}: {expected} != {actual}")
+
+        before_rate = items_per_second(before, items, args.repeat)
+        after_rate = items_per_second(after, items, args.repeat)
+        print(f"{name:<36} {before_rate:>15,.0f} {after_rate:>15,.0f} {after_rate / before_rate:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
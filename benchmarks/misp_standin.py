@@ -0,0 +1,314 @@
+"""
+Local MISP stand-in server for offline benchmarks.
+
+Serves a deterministic, generated data set of events and attributes and emulates the
+endpoints used by the app:
+
+- /events/restSearch      (page, limit, publish_timestamp, eventid)
+- /attributes/restSearch  (page, limit, eventid, timestamp, value)
+- /sightings/add
+
+Responses carry the X-Result-Count and (optionally) X-Skipped-Elements-Count headers.
+A configurable latency is added to every request, optionally growing with the page offset
+to emulate the OFFSET scans of deep pages, a share of requests can be rejected with
+HTTP 503 and Retry-After to emulate an overloaded instance, and requests/bytes are counted.
+
+Usage:
+    python benchmarks/misp_standin.py --events 1000 --attributes-per-event 1000 --latency 0.05
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BASE_TIMESTAMP = 1700000000
+
+ATTRIBUTE_TYPES = [
+    ('ip-dst', 'Network activity', '198.51.{}.{}'),
+    ('domain', 'Network activity', 'host{}-{}.example.com'),
+    ('domain|ip', 'Network activity', 'host{}-{}.example.net|203.0.113.7'),
+    ('url', 'Network activity', 'https://example.org/{}/{}/index.php'),
+    ('md5', 'Payload delivery', '{:016x}{:016x}'),
+    ('sha256', 'Payload delivery', '{:032x}{:032x}'),
+    ('email-src', 'Payload delivery', 'sender{}-{}@example.com'),
+]
+
+
+class MISPDataSet:
+    """
+    Generates events and attributes on demand, so large data sets do not have to be held in memory.
+    """
+    def __init__(self, event_count, attributes_per_event, tags_per_attribute=2, attributes_per_timestamp=10):
+        self.event_count = event_count
+        self.attributes_per_event = attributes_per_event
+        self.tags_per_attribute = tags_per_attribute
+        # attributes are ordered by timestamp, this amount of attributes shares a timestamp
+        self.attributes_per_timestamp = attributes_per_timestamp
+        self.value_index = None
+        self.value_index_lock = threading.Lock()
+
+    @property
+    def attribute_count(self):
+        return self.event_count * self.attributes_per_event
+
+    def event(self, event_id):
+        return {
+            'id': str(event_id),
+            'orgc_id': '1',
+            'org_id': '1',
+            'date': '2024-01-01',
+            'threat_level_id': '2',
+            'info': f'Benchmark event {event_id}',
+            'published': True,
+            'uuid': f'{event_id:032x}',
+            'attribute_count': str(self.attributes_per_event),
+            'analysis': '2',
+            'timestamp': str(BASE_TIMESTAMP + event_id),
+            'distribution': '1',
+            'proposal_email_lock': False,
+            'locked': False,
+            'publish_timestamp': str(BASE_TIMESTAMP + event_id),
+            'sharing_group_id': '0',
+            'disable_correlation': False,
+            'extends_uuid': '',
+            'Org': {'id': '1', 'name': 'BENCHMARK', 'uuid': f'{1:032x}'},
+            'Orgc': {'id': '1', 'name': 'BENCHMARK', 'uuid': f'{1:032x}'},
+            'Tag': [
+                {'id': '1', 'name': 'tlp:green', 'colour': '#33FF00', 'is_galaxy': False},
+                {'id': '2', 'name': f'benchmark:event="{event_id % 10}"', 'colour': '#0088cc', 'is_galaxy': False},
+            ],
+        }
+
+    def value(self, index):
+        event_id = index // self.attributes_per_event + 1
+        return ATTRIBUTE_TYPES[index % len(ATTRIBUTE_TYPES)][2].format(event_id, index)
+
+    def find_values(self, values):
+        # indexes of the attributes matching one of the values (or one part of composite values)
+        with self.value_index_lock:
+            if self.value_index is None:
+                self.value_index = {}
+                for index in range(self.attribute_count):
+                    value = self.value(index)
+                    for part in set([value] + value.split('|')):
+                        self.value_index.setdefault(part.lower(), []).append(index)
+        indexes = set()
+        for value in values:
+            indexes.update(self.value_index.get(str(value).lower(), []))
+        return sorted(indexes)
+
+    def attribute(self, index):
+        event_id = index // self.attributes_per_event + 1
+        misp_type, category, template = ATTRIBUTE_TYPES[index % len(ATTRIBUTE_TYPES)]
+        return {
+            'id': str(index + 1),
+            'event_id': str(event_id),
+            'object_id': '0',
+            'object_relation': None,
+            'category': category,
+            'type': misp_type,
+            'to_ids': True,
+            'uuid': f'{index + 1:032x}',
+            'timestamp': str(BASE_TIMESTAMP + index // self.attributes_per_timestamp),
+            'distribution': '5',
+            'sharing_group_id': '0',
+            'comment': '',
+            'deleted': False,
+            'disable_correlation': False,
+            'first_seen': None,
+            'last_seen': None,
+            'value': self.value(index),
+            'event_uuid': f'{event_id:032x}',
+            'Tag': [
+                {'id': str(tag), 'name': f'benchmark:tag="{tag}"', 'colour': '#ffffff', 'numerical_value': None, 'is_galaxy': False, 'local': 0}
+                for tag in range(self.tags_per_attribute)
+            ],
+        }
+
+
+class MISPStandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.send_json({'version': '2.4.999'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        request_body = json.loads(body) if body else {}
+        path = self.path.lstrip('/')
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if self.server.reject_request():
+            self.send_json({'name': 'Service Unavailable', 'message': 'Service Unavailable', 'url': self.path}, {'Retry-After': str(self.server.retry_after)}, status=503)
+            return
+
+        if path.startswith('events/restSearch'):
+            self.search_events(request_body)
+        elif path.startswith('attributes/restSearch'):
+            self.search_attributes(request_body)
+        elif path.startswith('sightings/add'):
+            self.send_json({'Sighting': {'id': '1', 'value': request_body.get('value'), 'type': str(request_body.get('type', 0))}})
+        else:
+            self.send_json({'name': 'Not Found', 'message': 'Not Found', 'url': self.path}, status=404)
+
+    @staticmethod
+    def page_range(request_body, total):
+        limit = int(request_body.get('limit') or 0)
+        page = int(request_body.get('page') or 0)
+        if not limit or not page:
+            return 0, total
+        start = min((page - 1) * limit, total)
+        return start, min(start + limit, total)
+
+    def search_events(self, request_body):
+        data_set = self.server.data_set
+        event_ids = range(1, data_set.event_count + 1)
+        if request_body.get('eventid'):
+            event_ids = [int(request_body['eventid'])]
+        if request_body.get('publish_timestamp'):
+            # events are published in id order, one per second
+            first = max(int(float(request_body['publish_timestamp'])) - BASE_TIMESTAMP, 1)
+            event_ids = range(first, data_set.event_count + 1)
+
+        start, end = self.page_range(request_body, len(event_ids))
+        events = [{'Event': data_set.event(event_id)} for event_id in event_ids[start:end]]
+        self.send_json({'response': events}, {'X-Result-Count': str(len(event_ids))})
+
+    def search_attributes(self, request_body):
+        data_set = self.server.data_set
+        if request_body.get('eventid'):
+            event_id = int(request_body['eventid'])
+            first = (event_id - 1) * data_set.attributes_per_event
+            indexes = range(first, first + data_set.attributes_per_event)
+        else:
+            indexes = range(0, data_set.attribute_count)
+        if request_body.get('value'):
+            values = request_body['value']
+            if isinstance(values, dict):
+                values = values.get('OR', [])
+            elif not isinstance(values, list):
+                values = [values]
+            indexes = [index for index in data_set.find_values(values) if index in indexes]
+        if request_body.get('timestamp'):
+            first = (int(request_body['timestamp']) - BASE_TIMESTAMP) * data_set.attributes_per_timestamp
+            if isinstance(indexes, range):
+                indexes = indexes[max(first - indexes.start, 0):]
+            else:
+                indexes = [index for index in indexes if index >= first]
+
+        start, end = self.page_range(request_body, len(indexes))
+        if self.server.offset_latency:
+            time.sleep(self.server.offset_latency * start / 100000)
+        attributes = [data_set.attribute(index) for index in indexes[start:end]]
+        headers = {'X-Result-Count': str(len(indexes))}
+        if self.server.skipped_elements_header:
+            headers['X-Skipped-Elements-Count'] = '0'
+        self.send_json({'response': {'Attribute': attributes}}, headers)
+
+    def send_json(self, payload, headers=None, status=200):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.count_request(len(data))
+
+
+class MISPStandIn(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, data_set, latency=0.0, skipped_elements_header=True, offset_latency=0.0, error_rate=0.0, retry_after=0, host='127.0.0.1', port=0):
+        super().__init__((host, port), MISPStandInHandler)
+        self.data_set = data_set
+        self.latency = latency
+        self.offset_latency = offset_latency
+        self.skipped_elements_header = skipped_elements_header
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(0)
+        self.stats_lock = threading.Lock()
+        self.request_count = 0
+        self.byte_count = 0
+        self.error_count = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def reject_request(self):
+        with self.stats_lock:
+            if not self.error_rate or self.random.random() >= self.error_rate:
+                return False
+            self.error_count += 1
+            return True
+
+    def count_request(self, byte_count):
+        with self.stats_lock:
+            self.request_count += 1
+            self.byte_count += byte_count
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.request_count = 0
+            self.byte_count = 0
+            self.error_count = 0
+
+    def get_stats(self):
+        with self.stats_lock:
+            return {'requests': self.request_count, 'bytes': self.byte_count, 'errors': self.error_count}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def add_arguments(parser):
+    parser.add_argument('--events', type=int, default=100, help='amount of generated events')
+    parser.add_argument('--attributes-per-event', type=int, default=1000, help='amount of generated attributes per event')
+    parser.add_argument('--tags-per-attribute', type=int, default=2)
+    parser.add_argument('--attributes-per-timestamp', type=int, default=10, help='amount of generated attributes which share a timestamp')
+    parser.add_argument('--latency', type=float, default=0.0, help='latency added to each request in seconds')
+    parser.add_argument('--offset-latency', type=float, default=0.0, help='latency added to attribute requests per 100k attributes of page offset in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests rejected with HTTP 503')
+    parser.add_argument('--retry-after', type=int, default=0, help='Retry-After of rejected requests in seconds')
+    parser.add_argument('--no-skipped-elements-header', action='store_true', help='emulate MISP versions without X-Skipped-Elements-Count')
+
+
+def from_arguments(args, port=0):
+    data_set = MISPDataSet(args.events, args.attributes_per_event, args.tags_per_attribute, args.attributes_per_timestamp)
+    return MISPStandIn(data_set, args.latency, not args.no_skipped_elements_header, args.offset_latency, args.error_rate, args.retry_after, port=port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    server = from_arguments(args, args.port)
+    print(f'MISP stand-in listening on {server.url}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
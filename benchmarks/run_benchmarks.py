@@ -0,0 +1,332 @@
+"""
+Offline throughput benchmarks of the inputs, search commands and the sighting alert action.
+
+A local MISP stand-in server (see misp_standin.py) serves a generated data set, each scenario
+runs in a separate process against it and reports items/sec, requests, response bytes,
+output bytes and the peak memory (max RSS) of the scenario process.
+
+Scenarios:
+    indicator_input   misp_indicator_input_helper.stream_events (continuous importing)
+    event_input       misp_event_input_helper.stream_events
+    search_attributes SearchMISPAttributesCommand.generate
+    search_events     SearchMISPEventsCommand.generate
+    enrich            MISPEnrichCommand.stream over generated events (chunks of 50000 events)
+    sightings         modalert_add_sighting_helper.process_event
+
+Usage:
+    python benchmarks/run_benchmarks.py --events 1000 --attributes-per-event 1000
+    python benchmarks/run_benchmarks.py --scenario indicator_input --input-option event_workers=4 --latency 0.05
+
+Requires the python dependencies of the app (requests, solnlib, splunk-sdk).
+"""
+import argparse
+import io
+import json
+import logging
+import math
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from itertools import islice
+from types import ModuleType, SimpleNamespace
+
+import misp_standin
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'package', 'bin')
+
+SCENARIOS = ['indicator_input', 'event_input', 'search_attributes', 'search_events', 'enrich', 'sightings']
+ENRICH_CHUNK_SIZE = 50000
+
+
+class CountingTextSink(io.TextIOBase):
+    """
+    Output stream of the fake EventWriter, counts written events and characters.
+    """
+    def __init__(self):
+        self.event_count = 0
+        self.char_count = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.event_count += data.count('<event')
+        self.char_count += len(data)
+        return len(data)
+
+
+class CountingBinarySink(io.RawIOBase):
+    """
+    Output stream of the search command record writer, counts written bytes.
+    """
+    def __init__(self):
+        self.byte_count = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.byte_count += len(data)
+        return len(data)
+
+
+def parse_options(options):
+    return dict(option.split('=', 1) for option in options or [])
+
+
+def setup_child(config):
+    sys.path.insert(0, BIN_DIR)
+    # generated by ucc-gen, only extends sys.path in the built app
+    sys.modules.setdefault('import_declare_test', ModuleType('import_declare_test'))
+
+    logging.basicConfig(level=config['log_level'], stream=sys.stderr)
+
+    import splunk_generic
+    account = {
+        'misp_url': config['url'],
+        'auth_key': 'benchmark',
+        'tls_verify': '0',
+        'request_attribute_limit': '1000',
+        'request_event_limit': '100',
+        **config['account_options'],
+    }
+    splunk_generic.get_account = lambda session_key, account_name: dict(account)
+    splunk_generic.get_proxy_config = lambda session_key: None
+    splunk_generic.get_global_config = lambda session_key: {'default_instance': 'benchmark', **config['global_options']}
+    splunk_generic.get_log_level = lambda session_key, logger: config['log_level']
+    splunk_generic.set_log_level = lambda session_key, logger: logger.setLevel(config['log_level'])
+
+
+def run_input(module_name, config):
+    import importlib
+    from splunklib import modularinput as smi
+
+    module = importlib.import_module(module_name)
+    module.logger_for_input = lambda input_name: logging.getLogger(input_name)
+
+    # each stanza imports the data set from its own instance
+    stanzas = {}
+    for stanza in range(config['stanzas']):
+        name = 'benchmark' if stanza == 0 else f'benchmark_{stanza}'
+        stanzas[f'{module_name}://{name}'] = {
+            'misp_instance': name,
+            'index': 'benchmark',
+            'sourcetype': 'misp:benchmark',
+            'import_period': 'all',
+            **config['input_options'],
+        }
+    sink = CountingTextSink()
+    event_writer = smi.EventWriter(sink, sys.stderr)
+    with tempfile.TemporaryDirectory() as checkpoint_dir:
+        inputs = SimpleNamespace(
+            metadata={'session_key': 'benchmark', 'checkpoint_dir': checkpoint_dir},
+            inputs=stanzas
+        )
+        module.stream_events(inputs, event_writer)
+    event_writer.close()
+    return {'items': sink.event_count, 'output_bytes': sink.char_count}
+
+
+def run_search(module_name, command_name, config):
+    import importlib
+    from splunklib.searchcommands.internals import RecordWriterV2
+
+    module = importlib.import_module(module_name)
+    command = getattr(module, command_name)()
+    command.options.reset()
+    for name, value in config['search_options'].items():
+        setattr(command, name, value)
+
+    sink = CountingBinarySink()
+    command._metadata = SimpleNamespace(searchinfo=SimpleNamespace(session_key='benchmark'))
+    command._record_writer = RecordWriterV2(sink)
+
+    # like GeneratingCommand, records are collected per chunk before they are written
+    item_count = 0
+    records = command.generate()
+    while True:
+        chunk = list(islice(records, command._record_writer._maxresultrows))
+        for record in chunk:
+            command._record_writer.write_record(record)
+        item_count += len(chunk)
+        if len(chunk) < command._record_writer._maxresultrows:
+            break
+        command._record_writer.write_chunk(finished=False)
+    command._record_writer.flush(finished=True)
+    return {'items': item_count, 'output_bytes': sink.byte_count}
+
+
+def run_enrich(config):
+    import enrich_command
+    from splunklib.searchcommands.internals import RecordWriterV2
+
+    command = enrich_command.MISPEnrichCommand()
+    command.options.reset()
+    command.field = 'dest'
+    for name, value in config['search_options'].items():
+        setattr(command, name, value)
+
+    sink = CountingBinarySink()
+    command._metadata = SimpleNamespace(searchinfo=SimpleNamespace(session_key='benchmark'))
+    command._record_writer = RecordWriterV2(sink)
+
+    # every second distinct value is the value of an attribute of the data set
+    data_set = misp_standin.MISPDataSet(config['events'], config['attributes_per_event'])
+    distinct = config['enrich_distinct']
+    stride = max(data_set.attribute_count // distinct, 1)
+
+    def value(i):
+        k = i % distinct
+        return data_set.value(k * stride % data_set.attribute_count) if k % 2 == 0 else f'miss{k}.example.org'
+
+    item_count = 0
+    for chunk_start in range(0, config['enrich_events'], ENRICH_CHUNK_SIZE):
+        chunk_end = min(chunk_start + ENRICH_CHUNK_SIZE, config['enrich_events'])
+        records = ({'_raw': f'event {i}', 'dest': value(i)} for i in range(chunk_start, chunk_end))
+        for record in command.stream(records):
+            command._record_writer.write_record(record)
+            item_count += 1
+        command._record_writer.write_chunk(finished=chunk_end == config['enrich_events'])
+    return {'items': item_count, 'output_bytes': sink.byte_count}
+
+
+def run_sightings(config):
+    from ta_misp import modalert_add_sighting_helper
+
+    params = {'misp_instance': 'benchmark', 'ioc': '198.51.100.1', 'sighting_type': '0'}
+    helper = SimpleNamespace(
+        session_key='benchmark',
+        get_param=params.get,
+        log_info=logging.getLogger('sightings').info
+    )
+    for _ in range(config['sightings']):
+        modalert_add_sighting_helper.process_event(helper)
+    return {'items': config['sightings'], 'output_bytes': 0}
+
+
+def run_scenario(scenario, config):
+    setup_child(config)
+    started = time.perf_counter()
+    if scenario == 'indicator_input':
+        result = run_input('misp_indicator_input_helper', config)
+    elif scenario == 'event_input':
+        result = run_input('misp_event_input_helper', config)
+    elif scenario == 'search_attributes':
+        result = run_search('search_attributes_command', 'SearchMISPAttributesCommand', config)
+    elif scenario == 'search_events':
+        result = run_search('search_events_command', 'SearchMISPEventsCommand', config)
+    elif scenario == 'enrich':
+        result = run_enrich(config)
+    elif scenario == 'sightings':
+        result = run_sightings(config)
+    else:
+        raise Exception(f'Unknown scenario {scenario}')
+    result['seconds'] = time.perf_counter() - started
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    result['max_rss_mb'] = max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return result
+
+
+def run_child(scenario, config):
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', scenario, '--child-config', json.dumps(config)],
+        stdout=subprocess.PIPE,
+        check=True
+    )
+    return json.loads(process.stdout.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    misp_standin.add_arguments(parser)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='scenario to run, may be repeated (default: all)')
+    parser.add_argument('--account-option', action='append', metavar='KEY=VALUE', help='override an account setting, e.g. request_attribute_limit=5000')
+    parser.add_argument('--input-option', action='append', metavar='KEY=VALUE', help='override an input setting, e.g. event_workers=4')
+    parser.add_argument('--global-option', action='append', metavar='KEY=VALUE', help='override an app setting, e.g. input_workers=1')
+    parser.add_argument('--stanzas', type=int, default=1, help='amount of input stanzas of different instances run by the input scenarios')
+    parser.add_argument('--search-option', action='append', metavar='KEY=VALUE', help='override a search command option, e.g. normalize_fields=f')
+    parser.add_argument('--search-limit', type=int, default=None, help='limit of the search commands (default: size of the data set)')
+    parser.add_argument('--sightings', type=int, default=1000, help='amount of sightings added in the sightings scenario')
+    parser.add_argument('--enrich-events', type=int, default=200000, help='amount of events enriched in the enrich scenario')
+    parser.add_argument('--enrich-distinct', type=int, default=20000, help='amount of distinct values of the enriched events, every second one matches an attribute')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--child-config', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_scenario(args.child, json.loads(args.child_config))))
+        return
+
+    server = misp_standin.from_arguments(args).start()
+    data_set = server.data_set
+    config = {
+        'url': server.url,
+        'log_level': args.log_level,
+        'account_options': parse_options(args.account_option),
+        'input_options': parse_options(args.input_option),
+        'global_options': parse_options(args.global_option),
+        'stanzas': args.stanzas,
+        'sightings': args.sightings,
+        'events': data_set.event_count,
+        'attributes_per_event': data_set.attributes_per_event,
+        'enrich_events': args.enrich_events,
+        'enrich_distinct': args.enrich_distinct,
+    }
+
+    results = []
+    try:
+        for scenario in args.scenario or SCENARIOS:
+            input_options = {}
+            if scenario == 'indicator_input':
+                # maximum amount of imported events
+                input_options['max_requests'] = str(data_set.event_count)
+            elif scenario == 'event_input':
+                # amount of requested event pages
+                request_event_limit = int(config['account_options'].get('request_event_limit', 100))
+                input_options['max_requests'] = str(math.ceil(data_set.event_count / request_event_limit) + 1)
+            input_options.update(config['input_options'])
+
+            search_options = {}
+            if scenario == 'search_attributes':
+                search_options['limit'] = str(args.search_limit or data_set.attribute_count)
+            elif scenario == 'search_events':
+                search_options['limit'] = str(args.search_limit or data_set.event_count)
+            search_options.update(parse_options(args.search_option))
+
+            server.reset_stats()
+            result = run_child(scenario, {**config, 'input_options': input_options, 'search_options': search_options})
+            server_stats = server.get_stats()
+            results.append({
+                'scenario': scenario,
+                'items': result['items'],
+                'seconds': round(result['seconds'], 3),
+                'items_per_sec': round(result['items'] / result['seconds']) if result['seconds'] else 0,
+                'requests': server_stats['requests'],
+                'errors': server_stats['errors'],
+                'response_mb': round(server_stats['bytes'] / 1024 / 1024, 1),
+                'output_mb': round(result['output_bytes'] / 1024 / 1024, 1),
+                'max_rss_mb': round(result['max_rss_mb'], 1),
+            })
+    finally:
+        server.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    columns = ['scenario', 'items', 'seconds', 'items_per_sec', 'requests', 'errors', 'response_mb', 'output_mb', 'max_rss_mb']
+    print(f'data set: {data_set.event_count} events, {data_set.attribute_count} attributes, latency {args.latency}s')
+    print(''.join(f'{column:>18}' for column in columns))
+    for result in results:
+        print(''.join(f'{result[column]:>18}' for column in columns))
+
+
+if __name__ == '__main__':
+    main()
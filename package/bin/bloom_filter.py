@@ -0,0 +1,210 @@
+import math
+import os
+import struct
+from hashlib import blake2b
+
+from ioc_store import store_file_name
+from misp_client import split_ioc_value
+
+MAGIC = b'MISPBLM1'
+# magic, version (seq of the IOC store), amount of groups
+HEADER = struct.Struct('<8sQI')
+# group name, bits, hashes, count, capacity
+GROUP = struct.Struct('<16sQIQQ')
+
+DEFAULT_FALSE_POSITIVE_RATE = 0.01
+MIN_CAPACITY = 10000
+# group of the values of types which are not in IOC_TYPE_GROUPS
+OTHER_GROUP = 'other'
+
+
+def value_hashes(value):
+    # two 64 bit hashes of the normalized value, the bit positions are derived by double hashing
+    digest = blake2b(value.strip().lower().encode('utf-8'), digest_size=16).digest()
+    return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+
+
+class BloomFilter:
+    """
+    Bloom filter of the values of one IOC group. count is the amount of added values
+    which set at least one new bit, so values added again do not count.
+    """
+    def __init__(self, capacity, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE, bit_count=None, hash_count=None, bits=None, count=0):
+        self.capacity = max(capacity, MIN_CAPACITY)
+        if bit_count is None:
+            bit_count = math.ceil(-self.capacity * math.log(false_positive_rate) / math.log(2) ** 2)
+            bit_count = (bit_count + 7) // 8 * 8
+            hash_count = max(round(bit_count / self.capacity * math.log(2)), 1)
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+        self.bits = bits if bits is not None else bytearray(bit_count // 8)
+        self.count = count
+
+    def _positions(self, hashes):
+        h1, h2 = hashes
+        bit_count = self.bit_count
+        return [(h1 + i * h2) % bit_count for i in range(self.hash_count)]
+
+    def add(self, hashes):
+        bits = self.bits
+        new = False
+        for position in self._positions(hashes):
+            byte, mask = position >> 3, 1 << (position & 7)
+            if not bits[byte] & mask:
+                bits[byte] |= mask
+                new = True
+        if new:
+            self.count += 1
+
+    def contains(self, hashes):
+        bits = self.bits
+        for position in self._positions(hashes):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    @property
+    def full(self):
+        return self.count > self.capacity
+
+
+class IOCBloomFilter:
+    """
+    Bloom filters of the values in the IOC store per IOC group (see IOC_TYPE_GROUPS, values
+    of other types are in the group other), negatives are certain, so exact lookups (IOC store, MISP) can be skipped for them.
+
+    The filters are updated while attributes are added to the IOC store and saved with the
+    seq of the store they cover. If they do not match the store (e.g. after an aborted run or
+    while another input added attributes) or are full, they are rebuilt from the store. Removed attributes remain in the filters until
+    the next rebuild, which only causes false positives.
+    """
+    def __init__(self, path, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE):
+        self.path = path
+        self.false_positive_rate = false_positive_rate
+        self.version = None
+        self.filters = {}
+
+    @classmethod
+    def for_account(cls, state_dir, account_name, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE):
+        return cls(os.path.join(state_dir, 'bloom_filter', store_file_name(account_name) + '.bloom'), false_positive_rate)
+
+    def load(self):
+        """
+        Loads the saved filters, returns False if there are none
+        """
+        try:
+            with open(self.path, 'rb') as bloom_file:
+                data = bloom_file.read()
+        except OSError:
+            return False
+        magic, version, group_count = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            return False
+        offset = HEADER.size
+        filters = {}
+        for _ in range(group_count):
+            name, bit_count, hash_count, count, capacity = GROUP.unpack_from(data, offset)
+            offset += GROUP.size
+            size = bit_count // 8
+            filters[name.rstrip(b'\0').decode('utf-8')] = BloomFilter(
+                capacity, bit_count=bit_count, hash_count=hash_count, bits=bytearray(data[offset:offset + size]), count=count
+            )
+            offset += size
+        self.version = version
+        self.filters = filters
+        return True
+
+    def save(self, version):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as bloom_file:
+            bloom_file.write(HEADER.pack(MAGIC, version, len(self.filters)))
+            for name, bloom_filter in sorted(self.filters.items()):
+                bloom_file.write(GROUP.pack(name.encode('utf-8'), bloom_filter.bit_count, bloom_filter.hash_count, bloom_filter.count, bloom_filter.capacity))
+                bloom_file.write(bloom_filter.bits)
+        os.replace(temp_path, self.path)
+        self.version = version
+
+    def add(self, group, value):
+        bloom_filter = self.filters.get(group)
+        if bloom_filter is None:
+            bloom_filter = self.filters[group] = BloomFilter(MIN_CAPACITY, self.false_positive_rate)
+        bloom_filter.add(value_hashes(value))
+
+    def add_attribute(self, misp_type, value):
+        for group, part in split_ioc_value(misp_type, value, OTHER_GROUP):
+            self.add(group, part)
+
+    def add_attributes(self, attributes, first_seq, last_seq):
+        """
+        Adds the (type, value) pairs of the attributes which were stored with the seqs first_seq
+        to last_seq. The filters only cover the store up to a seq if no other process (another
+        input of the instance) added attributes since the filters were loaded.
+        """
+        for misp_type, value in attributes:
+            self.add_attribute(misp_type, value)
+        self.version = last_seq if self.version is not None and self.version == first_seq - 1 else None
+
+    def _might_contain(self, value, groups):
+        hashes = value_hashes(value)
+        for group in groups or self.filters:
+            bloom_filter = self.filters.get(group)
+            if bloom_filter is not None and bloom_filter.contains(hashes):
+                return True
+        return False
+
+    def might_contain(self, value, groups=None):
+        """
+        Returns False if the value is certainly not in any of the groups (all groups if None),
+        composite values (e.g. domain|ip) may be in the store by their parts
+        """
+        if self._might_contain(value, groups):
+            return True
+        return '|' in value and all(self._might_contain(part, groups) for part in value.split('|'))
+
+    @property
+    def full(self):
+        return any(bloom_filter.full for bloom_filter in self.filters.values())
+
+    def rebuild(self, ioc_store):
+        """
+        Rebuilds the filters from all values in the IOC store, sized for twice the
+        current amount of values per group
+        """
+        version = ioc_store.get_stats()['ioc_store_seq']
+        pairs = {pair for misp_type, value in ioc_store.iter_values() for pair in split_ioc_value(misp_type or '', value, OTHER_GROUP)}
+        counts = {}
+        for group, value in pairs:
+            counts[group] = counts.get(group, 0) + 1
+        self.filters = {group: BloomFilter(2 * count, self.false_positive_rate) for group, count in counts.items()}
+        for group, value in pairs:
+            self.filters[group].add(value_hashes(value))
+        self.save(version)
+
+    def open(self, ioc_store):
+        """
+        Loads the filters for updates while attributes are added to the IOC store, they are
+        rebuilt if they do not match the store
+        """
+        if not self.load() or self.version != ioc_store.get_stats()['ioc_store_seq'] or self.full:
+            self.rebuild(ioc_store)
+        ioc_store.bloom_filter = self
+
+    def close(self, ioc_store):
+        # saves the updated filters with the seq they cover, full filters are rebuilt with a larger
+        # capacity and filters which miss attributes added by another process are rebuilt
+        ioc_store.bloom_filter = None
+        if self.full or self.version is None or self.version != ioc_store.get_stats()['ioc_store_seq']:
+            self.rebuild(ioc_store)
+        else:
+            self.save(self.version)
+
+    def load_current(self, ioc_store):
+        """
+        Loads the filters for lookups, returns False if there are none or they do not match
+        the store (e.g. while an input is adding attributes), as they could miss values
+        """
+        return self.load() and self.version == ioc_store.get_stats()['ioc_store_seq']
+
+    def get_stats(self):
+        return {group: {'count': bloom_filter.count, 'capacity': bloom_filter.capacity} for group, bloom_filter in self.filters.items()}
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import import_declare_test
+
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib"))
+
+from splunklib.searchcommands import \
+    dispatch, GeneratingCommand, Configuration, Option, validators
+
+import splunk_generic
+from ioc_store import IOCStore
+from ti_export import IncrementalTIBuilder
+from decay_scores import DECAY_SETTINGS
+
+@Configuration()
+class MISPBuildTICommand(GeneratingCommand):
+    """ Returns the rows of the MISP_TI_* lookups, updated incrementally from the local IOC stores.
+
+    ##Syntax
+    -- code-block::
+    | mispbuildti (misp_instance=<string>,<string>,...)? | `misp_ti_outputlookups`
+
+    ##Description
+    Reads the attributes which the indicator inputs added to the local IOC stores of the instances since
+    the last build, merges them into the aggregated IOCs and removes expired attributes. Returns the rows
+    of all MISP_TI_* lookups with weights decayed to the current age, the field report names the lookup
+    of a row. The misp_ti_outputlookups macro writes them with outputlookup.
+    """
+
+    misp_instance = Option(
+        doc='''
+        **Syntax:** **misp_instance=InstanceName,InstanceName,...*
+        **Description:** Names of the Instances whose IOC stores are exported
+        default_instance is used if parameter is not provided
+        ''',
+        require=False,
+        default=None,
+        validate=validators.List()
+    )
+
+    def generate(self):
+        session_key = self._metadata.searchinfo.session_key
+        general_settings = splunk_generic.get_global_config(session_key)
+        decay_settings = splunk_generic.get_settings(session_key, DECAY_SETTINGS)
+        log_level = splunk_generic.get_log_level(session_key, self.logger)
+        self.logger.setLevel(log_level)
+
+        instances = self.misp_instance
+        if not instances and general_settings.get('default_instance', None):
+            instances = [general_settings['default_instance']]
+
+        if not instances:
+            raise Exception('Either parameter "misp_instance" or setting "default_instance" must be specified')
+
+        state_dir = splunk_generic.get_state_dir()
+        now = time.time()
+        ioc_stores = {instance: IOCStore.for_account(state_dir, instance, readonly=True) for instance in instances}
+        try:
+            with IncrementalTIBuilder.for_state_dir(state_dir) as builder:
+                stats = builder.build(ioc_stores, now)
+                self.logger.debug(f"MISP TI build: {stats}")
+                for row in builder.iter_lookup_rows(now, decay_settings):
+                    row['_time'] = now
+                    yield row
+        finally:
+            for ioc_store in ioc_stores.values():
+                ioc_store.close()
+
+
+dispatch(MISPBuildTICommand, sys.argv, sys.stdin, sys.stdout, __name__)
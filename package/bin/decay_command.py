@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+import import_declare_test
+
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib"))
+
+from splunklib.searchcommands import \
+    dispatch, StreamingCommand, Configuration, Option, validators
+
+from decay_scores import DecayScorer, read_decay_settings
+from ti_export import REPORTS
+
+@Configuration(distributed=True)
+class MISPDecayCommand(StreamingCommand):
+    """ Computes the decaying scores of MISP attribute events.
+
+    ##Syntax
+    -- code-block::
+    | mispdecay (report=<report>)? (lifetime=<int>)? (decay_speed=<number>)? (timestamp_field=<field>)? (tag_field=<field>)? (org_field=<field>)?
+
+    ##Description
+    Adds the fields org_score, tag_score (decaying models of misp_decaying_scores.csv by creator org id and tag)
+    and generic_score (100 decaying over lifetime days) to each event. misp_decaying_scores.csv is loaded once per search.
+    The lifetime and decay speed are taken from the decaying settings of the app unless they are given,
+    the search peers read them from ta_misp_settings.conf of the knowledge bundle.
+    """
+
+    report = Option(
+        doc='''
+        **Syntax:** **report=<report>*
+        **Description:** MISP_TI_* report (domain, url, email, hash or ip) whose lifetime setting is used
+        **Default:** the generic lifetime setting
+        ''',
+        require=False,
+        default=None,
+        validate=validators.Set(*REPORTS)
+    )
+
+    lifetime = Option(
+        doc='''
+        **Syntax:** **lifetime=<int>*
+        **Description:** Lifetime in days of the generic score, overrides the setting
+        **Default:** lifetime setting of the report
+        ''',
+        require=False,
+        default=None,
+        validate=validators.Integer(minimum=1)
+    )
+
+    decay_speed = Option(
+        doc='''
+        **Syntax:** **decay_speed=<number>*
+        **Description:** Decay speed of the generic score, 1 decays linear, overrides the setting
+        **Default:** decay_speed setting
+        ''',
+        require=False,
+        default=None,
+        validate=validators.Float(minimum=0.01)
+    )
+
+    timestamp_field = Option(
+        doc='''
+        **Syntax:** **timestamp_field=<field>*
+        **Description:** Field with the attribute timestamp
+        **Default:** misp_timestamp
+        ''',
+        require=False,
+        default='misp_timestamp',
+        validate=validators.Fieldname()
+    )
+
+    tag_field = Option(
+        doc='''
+        **Syntax:** **tag_field=<field>*
+        **Description:** Field with the tags, may be a multivalue field
+        **Default:** misp_tag
+        ''',
+        require=False,
+        default='misp_tag',
+        validate=validators.Fieldname()
+    )
+
+    org_field = Option(
+        doc='''
+        **Syntax:** **org_field=<field>*
+        **Description:** Field with the creator org id
+        **Default:** misp_orgc_id
+        ''',
+        require=False,
+        default='misp_orgc_id',
+        validate=validators.Fieldname()
+    )
+
+    scorer = None
+
+    @staticmethod
+    def get_values(record, field):
+        values = record.get(field)
+        if not values:
+            return ()
+        return values if isinstance(values, list) else (values,)
+
+    def stream(self, records):
+        if self.scorer is None:
+            # runs on the search peers, the settings are read from the knowledge bundle
+            self.scorer = DecayScorer.from_settings(read_decay_settings(), self.report, self.lifetime, self.decay_speed)
+
+        get_scores = self.scorer.get_scores
+        get_values = self.get_values
+        for record in records:
+            org_score, tag_score, generic_score = get_scores(
+                record.get(self.timestamp_field),
+                get_values(record, self.tag_field),
+                get_values(record, self.org_field)
+            )
+            # the fields are set on all events, as the fields of a chunk are set by its first event
+            self.add_field(record, 'org_score', org_score)
+            self.add_field(record, 'tag_score', tag_score)
+            self.add_field(record, 'generic_score', generic_score)
+            yield record
+
+
+dispatch(MISPDecayCommand, sys.argv, sys.stdin, sys.stdout, __name__)
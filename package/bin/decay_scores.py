@@ -0,0 +1,128 @@
+import configparser
+import csv
+import os
+import time
+
+# directory of the app, on the search peers the one in the knowledge bundle
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# lookup table with the decaying models of tags and creator organisations, part of the knowledge bundle
+DECAY_SCORES_PATH = os.path.join(APP_DIR, 'lookups', 'misp_decaying_scores.csv')
+
+# stanza of ta_misp_settings.conf with the lifetime and decay speed of the generic score,
+# the defaults are in default/ta_misp_settings.conf
+SETTINGS_CONF = 'ta_misp_settings.conf'
+DECAY_SETTINGS = 'decaying'
+SECONDS_PER_DAY = 60 * 60 * 24
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def read_decay_settings(app_dir=APP_DIR):
+    """
+    Returns the decaying settings of the default and local ta_misp_settings.conf of the app.
+    The conf files are part of the knowledge bundle, so the search peers read the settings of
+    the search head without REST calls.
+    """
+    parser = configparser.ConfigParser(interpolation=None, strict=False, comment_prefixes=('#', ';'))
+    parser.optionxform = str
+    parser.read([os.path.join(app_dir, folder, SETTINGS_CONF) for folder in ('default', 'local')], encoding='utf-8')
+    if not parser.has_section(DECAY_SETTINGS):
+        raise Exception(f"Settings {DECAY_SETTINGS} not found")
+    return dict(parser[DECAY_SETTINGS])
+
+
+def decay(initial_score, age_days, lifetime, decay_speed):
+    """
+    Returns initial_score * (1 - (age_days / lifetime) ^ (1 / decay_speed)) or None if the
+    model is invalid. Negative ages (timestamps in the future) are handled as age 0.
+    """
+    if initial_score is None or not lifetime or not decay_speed:
+        return None
+    return initial_score * (1 - (max(age_days, 0) / lifetime) ** (1 / decay_speed))
+
+
+class DecayModel:
+    """
+    Row of misp_decaying_scores.csv, static models always have the Score,
+    dynamic models decay from the Score over DecayLifetime days
+    """
+    __slots__ = ('score', 'static', 'lifetime', 'decay_speed')
+
+    def __init__(self, row):
+        self.score = _float(row.get('Score'))
+        self.static = row.get('Type') == 'static'
+        self.lifetime = _float(row.get('DecayLifetime'))
+        self.decay_speed = _float(row.get('DecaySpeed'))
+
+    def get_score(self, age_days):
+        if self.static:
+            return self.score
+        return decay(self.score, age_days, self.lifetime, self.decay_speed)
+
+
+class DecayScorer:
+    """
+    Computes the org, tag and generic scores of attributes like the lookups and evals of the
+    TI reports did. The decaying models are indexed by tag and org id once, the first row
+    of a tag or org id is used.
+    """
+    def __init__(self, lifetime, decay_speed, path=DECAY_SCORES_PATH, now=None):
+        self.lifetime = lifetime
+        self.decay_speed = decay_speed
+        self.now = now if now is not None else time.time()
+        self.tag_models = {}
+        self.org_models = {}
+        if os.path.exists(path):
+            with open(path, newline='', encoding='utf-8') as scores_file:
+                for row in csv.DictReader(scores_file):
+                    if row.get('Tag'):
+                        self.tag_models.setdefault(row['Tag'], DecayModel(row))
+                    if row.get('OrgId'):
+                        self.org_models.setdefault(row['OrgId'], DecayModel(row))
+
+    @classmethod
+    def from_settings(cls, settings, report=None, lifetime=None, decay_speed=None, path=DECAY_SCORES_PATH, now=None):
+        """
+        Scorer with the lifetime of the report (or the generic one) and the decay speed of the
+        decaying settings, lifetime and decay_speed override them if given
+        """
+        if lifetime is None:
+            lifetime = _float(settings.get(f'{report}_lifetime') if report else None) or _float(settings.get('lifetime'))
+        if decay_speed is None:
+            decay_speed = _float(settings.get('decay_speed'))
+        return cls(lifetime, decay_speed, path, now)
+
+    def age_days(self, timestamp):
+        timestamp = _float(timestamp)
+        if timestamp is None:
+            return None
+        return (self.now - timestamp) / SECONDS_PER_DAY
+
+    @staticmethod
+    def _max_score(models, keys, age_days):
+        # highest score of the models of the keys, None if no key has a model
+        score = None
+        for key in keys:
+            model = models.get(key)
+            if model is None:
+                continue
+            model_score = model.get_score(age_days)
+            if model_score is not None and (score is None or model_score > score):
+                score = model_score
+        return score
+
+    def get_scores(self, timestamp, tags=(), org_ids=()):
+        """
+        Returns (org_score, tag_score, generic_score), tags and org_ids are lists of values
+        """
+        age_days = self.age_days(timestamp)
+        if age_days is None:
+            return None, None, None
+        org_score = self._max_score(self.org_models, org_ids, age_days) if self.org_models else None
+        tag_score = self._max_score(self.tag_models, tags, age_days) if self.tag_models else None
+        return org_score, tag_score, decay(100, age_days, self.lifetime, self.decay_speed)
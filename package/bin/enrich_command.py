@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+import import_declare_test
+
+import sys
+import os
+import json
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib"))
+
+from splunklib.searchcommands import \
+    dispatch, StreamingCommand, Configuration, Option, validators
+
+import splunk_generic
+from misp_client import MISPHTTPClient
+from ioc_store import IOCStore
+from bloom_filter import IOCBloomFilter
+
+@Configuration(local=True)
+class MISPEnrichCommand(StreamingCommand):
+    """ Enriches events with the MISP attributes matching the value of a field.
+
+    ##Syntax
+    -- code-block::
+    | mispenrich field=<field> (misp_instance=<string>)? (batch_size=<int>)? (types=<string>)? (to_ids=(t|f))? (prefilter=(t|f))?
+
+    ##Description
+    Collects the distinct values of the field within each chunk of events, queries them in batches
+    (one request per batch_size values) and adds the fields of the matching attributes (misp_* by default) to the events.
+    Results are kept for the lifetime of the search, so each value is only queried once. With prefilter=t values are
+    first tested against the Bloom filter of the local IOC store.
+    """
+
+    misp_instance = Option(
+        doc='''
+        **Syntax:** **misp_instance=InstanceName*
+        **Description:** Name of the Instance
+        default_instance is used if parameter is not provided
+        ''',
+        require=False,
+        default=None
+    )
+
+    field = Option(
+        doc='''
+        **Syntax:** **field=<field>*
+        **Description:** Field which holds the values (e.g. IPs, domains, hashes) to search in MISP, may be a multivalue field
+        ''',
+        require=True,
+        validate=validators.Fieldname()
+    )
+
+    batch_size = Option(
+        doc='''
+        **Syntax:** **batch_size=<int>*
+        **Description:** Amount of distinct values which are queried with one request
+        **Default:** 200
+        ''',
+        require=False,
+        default=200,
+        validate=validators.Integer(minimum=1, maximum=10000)
+    )
+
+    types = Option(
+        doc='''
+        **Syntax:** **types=<string>,<string>,...*
+        **Description:** MISP type filter, e.g.: \"domain,domain|ip\"
+        ''',
+        require=False,
+        validate=validators.Match("types", r"^[a-zA-Z0-9,|-]+$")
+    )
+
+    to_ids = Option(
+        doc='''
+        **Syntax:** **to_ids=<1|y|Y|t|true|True|0|n|N|f|false|False>*
+        **Description:** If enabled, only attributes with to_ids=true are matched
+        **Default:** False
+        ''',
+        require=False,
+        default=False,
+        validate=validators.Boolean()
+    )
+
+    published = Option(
+        doc='''
+        **Syntax:** **published=<1|y|Y|t|true|True|0|n|N|f|false|False>*
+        **Description:** Only match attributes which are published.
+        **Default:** True
+        ''',
+        require=False,
+        default=True,
+        validate=validators.Boolean()
+    )
+
+    include_tags = Option(
+        doc='''
+        **Syntax:** **include_tags=\"tlp:red,tlp:amber\"*
+        **Description:** MISP tag include filter, e.g.: \"tlp:red,tlp:amber\"
+        ''',
+        require=False,
+        validate=validators.Match("include_tags", r"^[a-zA-Z0-9,|:-]+$")
+    )
+
+    exclude_tags = Option(
+        doc='''
+        **Syntax:** **exclude_tags=\"tlp:red,tlp:amber\"*
+        **Description:** MISP tag exclude filter, e.g.: \"tlp:red,tlp:amber\"
+        ''',
+        require=False,
+        validate=validators.Match("exclude_tags", r"^[a-zA-Z0-9,|:-]+$")
+    )
+
+    warning_list = Option(
+        doc='''
+        **Syntax:** **warning_list=<1|y|Y|t|true|True|0|n|N|f|false|False>*
+        **Description:** Ignores Attributes which are in a warninglist.
+        **Default:** True
+        ''',
+        require=False,
+        default=True,
+        validate=validators.Boolean()
+    )
+
+    include_context = Option(
+        doc='''
+        **Syntax:** *include_context=<1|y|Y|t|true|True|0|n|N|f|false|False>*
+        **Description:** Includes Attribute Context (Event).
+        **Default:** False
+        ''',
+        require=False,
+        default=False,
+        validate=validators.Boolean()
+    )
+
+    prefilter = Option(
+        doc='''
+        **Syntax:** *prefilter=<1|y|Y|t|true|True|0|n|N|f|false|False>*
+        **Description:** Only queries values which may be in the local IOC store of the instance according to its Bloom filter
+        (indicator input with Local IOC Store and Bloom Filter enabled), values which are certainly not in the store are not queried.
+        **Default:** False
+        ''',
+        require=False,
+        default=False,
+        validate=validators.Boolean()
+    )
+
+    normalize_fields_prefix = Option(
+        doc='''
+        **Syntax:** **normalize_fields_prefix=\"misp_\"*
+        **Description:** Defines the prefix for the added fields, which is "misp_" by default.
+        ''',
+        require=False,
+        default="misp_",
+        validate=validators.Match("normalize_fields_prefix", r"^[a-zA-Z0-9_]+$")
+    )
+
+    misp_client = None
+    request_attribute_limit = 1000
+    attribute_mapper = None
+    bloom_filter = None
+    # enrichment fields by lower case value, None if the value does not match any attribute
+    matches = None
+
+    def setup(self):
+        session_key = self._metadata.searchinfo.session_key
+        general_settings = splunk_generic.get_global_config(session_key)
+        proxies = splunk_generic.get_proxy_config(session_key)
+        log_level = splunk_generic.get_log_level(session_key, self.logger)
+        self.logger.setLevel(log_level)
+
+        if not self.misp_instance:
+            self.misp_instance = general_settings.get('default_instance', None)
+
+        if not self.misp_instance:
+            raise Exception('Either parameter "misp_instance" or setting "default_instance" must be specified')
+
+        account = splunk_generic.get_account(session_key, self.misp_instance)
+        if splunk_generic.get_bool_val(account.get('ignore_proxy', "0")):
+            proxies = None
+        self.request_attribute_limit = int(account.get('request_attribute_limit', 1000))
+        self.misp_client = MISPHTTPClient.from_account(account, proxies, self.logger, interactive=True)
+        self.attribute_mapper = MISPHTTPClient.get_attribute_mapper(self.normalize_fields_prefix)
+        self.matches = {}
+
+        if self.prefilter:
+            bloom_filter = IOCBloomFilter.for_account(splunk_generic.get_state_dir(), self.misp_instance)
+            with IOCStore.for_account(splunk_generic.get_state_dir(), self.misp_instance, readonly=True) as ioc_store:
+                if bloom_filter.load_current(ioc_store):
+                    self.bloom_filter = bloom_filter
+                else:
+                    self.logger.warning(f"No current Bloom filter for instance {self.misp_instance}, all values are queried")
+
+    @staticmethod
+    def get_values(record, field):
+        values = record.get(field)
+        if not values:
+            return []
+        if not isinstance(values, list):
+            values = [values]
+        return [value.strip().lower() for value in values if value and value.strip()]
+
+    @staticmethod
+    def get_attribute_keys(attribute):
+        # MISP matches the complete value and either part of composite values (e.g. domain|ip)
+        value = attribute.get('value', '').lower()
+        keys = {value}
+        if '|' in attribute.get('type', ''):
+            keys.update(value.split('|'))
+        return keys
+
+    def query(self, values):
+        """
+        Queries the attributes matching any of the values and stores the merged fields
+        of the matching attributes per value
+        """
+        fields_by_value = {value: {} for value in values}
+        page = 0
+        while True:
+            page += 1
+            result = self.misp_client.get_attributes(
+                limit=self.request_attribute_limit,
+                page=page,
+                published=self.published,
+                to_ids=self.to_ids,
+                enforce_warninglist=self.warning_list,
+                include_context=self.include_context,
+                types=self.types,
+                include_tags=self.include_tags,
+                exclude_tags=self.exclude_tags,
+                value=values
+            )
+            attributes = result['response'].get('Attribute', [])
+            for attribute in attributes:
+                mapped = self.attribute_mapper.map(attribute)
+                for key in self.get_attribute_keys(attribute):
+                    fields = fields_by_value.get(key)
+                    if fields is None:
+                        continue
+                    for field, field_value in mapped.items():
+                        field_values = fields.setdefault(field, [])
+                        for item in field_value if isinstance(field_value, list) else [field_value]:
+                            if item not in field_values:
+                                field_values.append(item)
+
+            skipped = int(result['headers'].get('X-Skipped-Elements-Count', 0))
+            if len(attributes) + skipped < self.request_attribute_limit:
+                break
+
+        for value, fields in fields_by_value.items():
+            self.matches[value] = fields or None
+
+    def stream(self, records):
+        if self.misp_client is None:
+            self.setup()
+
+        # stream is called for each chunk of events, all values of the chunk are resolved
+        # before the events are written, as the fields of a chunk are set by its first event
+        records = list(records)
+        pending = []
+        prefiltered_count = 0
+        for record in records:
+            for value in self.get_values(record, self.field):
+                if value not in self.matches:
+                    self.matches[value] = None
+                    if self.bloom_filter is not None and not self.bloom_filter.might_contain(value):
+                        prefiltered_count += 1
+                        continue
+                    pending.append(value)
+        for i in range(0, len(pending), self.batch_size):
+            self.query(pending[i:i + self.batch_size])
+
+        enriched_count = 0
+        for record in records:
+            enrichment = {}
+            for value in self.get_values(record, self.field):
+                fields = self.matches.get(value)
+                if not fields:
+                    continue
+                for field, field_values in fields.items():
+                    merged = enrichment.setdefault(field, [])
+                    merged.extend(item for item in field_values if item not in merged)
+            if enrichment:
+                enriched_count += 1
+            for field, field_values in enrichment.items():
+                self.add_field(record, field, field_values[0] if len(field_values) == 1 else field_values)
+            yield record
+
+        self.logger.debug(f"MISP enriched {enriched_count} of {len(records)} events, queried {len(pending)} values, prefiltered {prefiltered_count} values, client: {self.misp_client.get_stats()}")
+
+
+dispatch(MISPEnrichCommand, sys.argv, sys.stdin, sys.stdout, __name__)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import import_declare_test
+
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib"))
+
+from splunklib.searchcommands import \
+    dispatch, ReportingCommand, Configuration
+
+import splunk_generic
+from ti_export import TIAggregator, REPORTS, RECORD_FIELDS, SECONDS_PER_DAY
+from decay_scores import DECAY_SETTINGS
+
+@Configuration()
+class MISPExportTICommand(ReportingCommand):
+    """ Returns the rows of all MISP_TI_* lookups from the indexed attribute events in one pass.
+
+    ##Syntax
+    -- code-block::
+    index=ioc sourcetype="misp:ti:attributes" earliest=-182d misp_to_ids=true | mispexportti | `misp_ti_outputlookups`
+
+    ##Description
+    Routes each attribute event to the lookups of its misp_domain, misp_url, misp_email, misp_hash and misp_ip
+    fields and aggregates them like the MISP_TI_* reports (decaying models of misp_decaying_scores.csv, cim_match_fields).
+    Events older than the period of a lookup (62 days, 182 days for hashes) by _time are not added to it. Returns the
+    rows of the five lookups once all events are read, the field report names the lookup of a row. The
+    misp_ti_outputlookups macro writes them with outputlookup.
+    """
+
+    aggregator = None
+    now = None
+    event_count = 0
+
+    @Configuration()
+    def map(self, records):
+        # only the aggregated fields are sent to the search head
+        fields = ('_time', 'source') + RECORD_FIELDS
+        for record in records:
+            yield {field: record[field] for field in fields if field in record}
+
+    def get_reports(self, record):
+        # reports whose period contains the event
+        try:
+            event_time = float(record.get('_time'))
+        except (TypeError, ValueError):
+            return list(REPORTS)
+        return [report for report, definition in REPORTS.items() if event_time >= self.now - definition['period_days'] * SECONDS_PER_DAY]
+
+    def reduce(self, records):
+        if self.aggregator is None:
+            self.aggregator = TIAggregator()
+            self.now = time.time()
+
+        # reduce is called for each chunk of events, the rows are returned with the last one
+        for record in records:
+            self.event_count += 1
+            if not record.get('misp_timestamp'):
+                continue
+            attribute_id = record.get('misp_attribute_id')
+            attribute_key = f"{record.get('source')}:{attribute_id}" if attribute_id else f'event:{self.event_count}'
+            self.aggregator.add(attribute_key, record, self.get_reports(record))
+
+        if not self._finished:
+            return
+
+        self.logger.debug(f"MISP TI export of {self.event_count} events: {self.aggregator.get_stats()}")
+        decay_settings = splunk_generic.get_settings(self._metadata.searchinfo.session_key, DECAY_SETTINGS)
+        for row in self.aggregator.iter_lookup_rows(self.now, decay_settings):
+            row['_time'] = self.now
+            yield row
+
+
+dispatch(MISPExportTICommand, sys.argv, sys.stdin, sys.stdout, __name__)
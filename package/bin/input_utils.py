@@ -1,57 +1,297 @@
 
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import json
+import queue
+import threading
 from splunklib import modularinput as smi
 
+# splunkd reads the output of modular inputs through a pipe, batches are written
+# at once when they reach this size, which matches the default pipe buffer on linux
+BATCH_BYTES = 64 * 1024
+
+
+def escape_xml(text):
+    # same escaping and ascii encoding as ElementTree.tostring used by smi.Event
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    if not text.isascii():
+        text = text.encode('ascii', 'xmlcharrefreplace').decode('ascii')
+    return text
+
+
+class EventBatch:
+    """
+    Serialized events which are written at once, passed to EventWriter.write_event like an smi.Event
+    """
+    def __init__(self, events):
+        self.events = events
+
+    def write_to(self, stream):
+        stream.write(''.join(self.events))
+        stream.flush()
+
+
 class SplunkEventIngestor:
-    def __init__(self, event_writer, index, source, sourcetype, override_timestamps=False):
+    def __init__(self, event_writer, index, source, sourcetype, override_timestamps=False, batch_size=1, batch_bytes=BATCH_BYTES, lock=None):
         self.event_writer = event_writer
         self.index = index
         self.source = source
         self.sourcetype = sourcetype
         self.override_timestamps = override_timestamps
 
+        # items may be ingested from several worker threads, ingestors of
+        # stanzas which run in parallel share the lock of their event writer
+        self.lock = lock or threading.Lock()
+
+        # batched writer mode, events are serialized like smi.Event.write_to and
+        # written by the event writer at once when batch_size events or batch_bytes
+        # characters are buffered, flush() must be called before checkpoints are updated
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.batch = []
+        self.batch_length = 0
+        self.encoder = json.JSONEncoder(ensure_ascii=False, default=str)
+        self.event_suffix = ''.join(
+            f'<{node}>{escape_xml(value)}</{node}>'
+            for node, value in [('source', source), ('sourcetype', sourcetype), ('index', index)]
+            if value is not None
+        ) + '<data>'
+
         # event stats
         self.event_count = 0
         self.skipped_item_count = 0
         self.total_items = 0
 
-    def ingest_event(self, event_data, event_time):
+    def ingest_event(self, event_data, event_time, encoded=False):
+        # encoded event_data is already a JSON text and written as it is
         if self.override_timestamps:
             event_time = int(datetime.now().timestamp())
+
+        if self.batch_size > 1:
+            self.buffer_event(event_data, event_time, encoded)
+            return
         
-        self.event_writer.write_event(
-            smi.Event(
-                data=json.dumps(
-                    event_data,
-                    ensure_ascii=False,
-                    default=str
-                ),
-                index=self.index,
-                source=self.source,
-                sourcetype=self.sourcetype,
-                time=event_time
-            )
+        event = smi.Event(
+            data=event_data if encoded else self.encode(event_data),
+            index=self.index,
+            source=self.source,
+            sourcetype=self.sourcetype,
+            time=event_time
         )
-        self.event_count += 1
+        with self.lock:
+            self.event_writer.write_event(event)
+            self.event_count += 1
 
-    def ingest_items(self, items, extract_function=lambda x:x, mapping_function=lambda x:x, skip_check=lambda x:False, timestamp_function=lambda x:x['timestamp']):
-        self.total_items += len(items)
-        
-        for item in items:
-            item = extract_function(item)
-            if skip_check(item):
-                self.skipped_item_count += 1
-                continue
+    def encode(self, event_data):
+        if isinstance(event_data, TagView):
+            return event_data.encode(self.encoder)
+        return self.encoder.encode(event_data)
+
+    def buffer_event(self, event_data, event_time, encoded=False):
+        event = ''.join([
+            '<event unbroken="1">',
+            '' if event_time is None else f'<time>{escape_xml(str(event_time))}</time>',
+            self.event_suffix,
+            escape_xml(event_data if encoded else self.encode(event_data)),
+            '</data><done /></event>'
+        ])
+        with self.lock:
+            self.batch.append(event)
+            self.batch_length += len(event)
+            self.event_count += 1
+            if len(self.batch) >= self.batch_size or self.batch_length >= self.batch_bytes:
+                self.write_batch()
+
+    def write_batch(self):
+        if not self.batch:
+            return
+        self.event_writer.write_event(EventBatch(self.batch))
+        self.batch = []
+        self.batch_length = 0
+
+    def flush(self):
+        # writes the buffered events of the batched writer mode
+        with self.lock:
+            self.write_batch()
 
-            event_data = mapping_function(item)
-            event_timestamp = timestamp_function(item)
+    def ingest_items(self, items, extract_function=lambda x:x, mapping_function=lambda x:x, skip_check=lambda x:False, timestamp_function=lambda x:x['timestamp'], raw_items=False):
+        # items may be a list or an iterator which is decoded while it is consumed
+        # raw_items are (item, json_text) tuples, json_text is ingested without mapping
+        item_count = 0
+        skipped_item_count = 0
+        try:
+            for item in items:
+                item_count += 1
+                if raw_items:
+                    item, raw_item = item
+                item = extract_function(item)
+                if skip_check(item):
+                    skipped_item_count += 1
+                    continue
 
-            self.ingest_event(event_data, event_timestamp)
+                event_timestamp = timestamp_function(item)
+                if raw_items:
+                    self.ingest_event(raw_item, event_timestamp, encoded=True)
+                else:
+                    self.ingest_event(mapping_function(item), event_timestamp)
+        finally:
+            with self.lock:
+                self.total_items += item_count
+                self.skipped_item_count += skipped_item_count
+        return item_count
 
     def get_stats(self):
         return {
             'event_count': self.event_count,
             'total_items': self.total_items,
             'skipped_item_count': self.skipped_item_count
-        }
\ No newline at end of file
+        }
+
+
+class ItemCounter:
+    """
+    Counts the items of a list or iterator while they are consumed and keeps the last one.
+    """
+    def __init__(self, items):
+        self.items = items
+        self.count = 0
+        self.last = None
+
+    def __iter__(self):
+        for item in self.items:
+            self.count += 1
+            self.last = item
+            yield item
+
+
+def run_stanzas(stanzas, run_stanza, workers=1):
+    """
+    Calls run_stanza(input_name, input_item) for each input stanza. Stanzas of different MISP
+    instances run in parallel on up to workers threads, stanzas of the same instance run in
+    sequence, so they do not compete for its connections and rate limits.
+    """
+    groups = {}
+    for input_name, input_item in stanzas.items():
+        groups.setdefault(input_item.get('misp_instance'), []).append((input_name, input_item))
+
+    if workers <= 1 or len(groups) <= 1:
+        for input_name, input_item in stanzas.items():
+            run_stanza(input_name, input_item)
+        return
+
+    def run_group(group):
+        for input_name, input_item in group:
+            run_stanza(input_name, input_item)
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(groups))) as executor:
+        for future in [executor.submit(run_group, group) for group in groups.values()]:
+            future.result()
+
+
+def prefetch(items, size=1):
+    """
+    Yields the items of an iterator which is consumed by a separate thread, so the next items
+    are produced while the current ones are processed. At most size items are buffered,
+    exceptions of the iterator are raised in the consumer. Closing the generator stops
+    the thread after its current item.
+    """
+    buffer = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+    done = object()
+
+    def put(entry):
+        # waits for free space until the consumer stops
+        while not stopped.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+class TagView(Mapping):
+    """
+    Read-only view of a MISP item (attribute or event) with Tag replaced by a single tag,
+    all other keys are read from the item. The views of an item share its JSON encoded
+    members, so they are encoded once per item instead of once per tag.
+    """
+    __slots__ = ('item', 'tag', 'members')
+
+    def __init__(self, item, tag, members):
+        self.item = item
+        self.tag = tag
+        self.members = members
+
+    def __getitem__(self, key):
+        if key == 'Tag':
+            return self.tag
+        return self.item[key]
+
+    def get(self, key, default=None):
+        if key == 'Tag':
+            return self.tag
+        return self.item.get(key, default)
+
+    def __contains__(self, key):
+        return key == 'Tag' or key in self.item
+
+    def __iter__(self):
+        yield from self.item
+        if 'Tag' not in self.item:
+            yield 'Tag'
+
+    def __len__(self):
+        return len(self.item) + ('Tag' not in self.item)
+
+    def encode(self, encoder):
+        # same text as encoder.encode(dict(self)), the tag is spliced in at the position of Tag
+        members = self.members
+        if not members:
+            members.extend(
+                None if key == 'Tag' else f'{encoder.encode(key)}: {encoder.encode(value)}'
+                for key, value in self.item.items()
+            )
+            if 'Tag' not in self.item:
+                members.append(None)
+        tag = f'"Tag": {encoder.encode(self.tag)}'
+        return '{' + ', '.join(tag if member is None else member for member in members) + '}'
+
+
+def iter_tag_views(items, extract_function=lambda x:x):
+    """
+    Yields a TagView of each extracted item per tag, items without tags are yielded once with Tag None
+    """
+    for item in items:
+        item = extract_function(item)
+        members = []
+        for tag in item.get('Tag') or [None]:
+            yield TagView(item, tag, members)
@@ -0,0 +1,165 @@
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from hashlib import blake2b
+
+from ioc_store import store_file_name
+
+MAGIC = b'MISPIOC1'
+FORMAT_VERSION = 1
+# magic, format version, snapshot version, creation time, amount of groups
+HEADER = struct.Struct('<8sIQdI')
+# group name, offset and amount of hashes
+GROUP = struct.Struct('<16sQQ')
+HASH = struct.Struct('<Q')
+
+SNAPSHOT_PREFIX = 'misp_ioc_snapshot_'
+SNAPSHOT_SUFFIX = '.bin'
+# snapshots are stored in the lookups folder of the app, which is part of the knowledge bundle
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lookups')
+
+
+def hash_value(value):
+    # 8 byte hash of the normalized value, collisions are unlikely below billions of values
+    digest = blake2b(value.strip().lower().encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def snapshot_path(account_name, snapshot_dir=SNAPSHOT_DIR):
+    return os.path.join(snapshot_dir, f'{SNAPSHOT_PREFIX}{store_file_name(account_name)}{SNAPSHOT_SUFFIX}')
+
+
+def write_snapshot(path, version, values):
+    """
+    Writes a snapshot of (group, value) pairs: a header, the group table and a sorted
+    array of unique little endian 8 byte value hashes per group. The file is replaced
+    atomically, readers keep the previous version mapped.
+    """
+    hashes = {}
+    for group, value in values:
+        hashes.setdefault(group, set()).add(hash_value(value))
+
+    groups = []
+    offset = HEADER.size + GROUP.size * len(hashes)
+    for group in sorted(hashes):
+        group_hashes = array('Q', sorted(hashes[group]))
+        if sys.byteorder == 'big':
+            group_hashes.byteswap()
+        groups.append((group, offset, group_hashes))
+        offset += len(group_hashes) * HASH.size
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'wb') as snapshot_file:
+        snapshot_file.write(HEADER.pack(MAGIC, FORMAT_VERSION, version, time.time(), len(groups)))
+        for group, offset, group_hashes in groups:
+            snapshot_file.write(GROUP.pack(group.encode('utf-8'), offset, len(group_hashes)))
+        for group, offset, group_hashes in groups:
+            group_hashes.tofile(snapshot_file)
+    os.replace(temp_path, path)
+    return {group: len(group_hashes) for group, offset, group_hashes in groups}
+
+
+def build_from_store(ioc_store, path):
+    """
+    Writes a snapshot of the values in the IOC store, unless the snapshot already has the
+    version (last seq) of the store. Returns the amount of hashes per group or None.
+    """
+    # only needed on the search head, the match command does not depend on the MISP client
+    from misp_client import split_ioc_value
+
+    version = ioc_store.get_stats()['ioc_store_seq']
+    if read_version(path) == version:
+        return None
+    values = (
+        pair
+        for misp_type, value in ioc_store.iter_values()
+        for pair in split_ioc_value(misp_type, value)
+    )
+    return write_snapshot(path, version, values)
+
+
+def read_version(path):
+    try:
+        with open(path, 'rb') as snapshot_file:
+            magic, format_version, version, created, group_count = HEADER.unpack(snapshot_file.read(HEADER.size))
+    except (OSError, struct.error):
+        return None
+    if magic != MAGIC or format_version != FORMAT_VERSION:
+        return None
+    return version
+
+
+class _HashArray:
+    # sequence of the little endian hashes of a group, used on big endian machines
+    def __init__(self, buffer, offset, count):
+        self.buffer = buffer
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return HASH.unpack_from(self.buffer, self.offset + index * HASH.size)[0]
+
+    def release(self):
+        self.buffer = None
+
+
+class IOCSnapshot:
+    """
+    Memory mapped snapshot, lookups are binary searches in the sorted hashes of a group,
+    so only the touched pages of the file are read.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as snapshot_file:
+            self.mmap = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, format_version, self.version, self.created, group_count = HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            self.mmap.close()
+            raise Exception(f"{path} is not a MISP IOC snapshot of version {FORMAT_VERSION}")
+
+        self.view = memoryview(self.mmap)
+        self.groups = {}
+        for index in range(group_count):
+            name, offset, count = GROUP.unpack_from(self.mmap, HEADER.size + index * GROUP.size)
+            name = name.rstrip(b'\0').decode('utf-8')
+            if sys.byteorder == 'little':
+                self.groups[name] = self.view[offset:offset + count * HASH.size].cast('Q')
+            else:
+                self.groups[name] = _HashArray(self.mmap, offset, count)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for hashes in self.groups.values():
+            hashes.release()
+        self.view.release()
+        self.mmap.close()
+
+    def contains(self, group, value_hash):
+        hashes = self.groups.get(group)
+        if hashes is None:
+            return False
+        index = bisect_left(hashes, value_hash)
+        return index < len(hashes) and hashes[index] == value_hash
+
+    def match(self, value, groups=None):
+        """
+        Returns the groups which contain the value
+        """
+        value_hash = hash_value(value)
+        return [group for group in (groups or self.groups) if self.contains(group, value_hash)]
+
+    def get_stats(self):
+        return {group: len(hashes) for group, hashes in self.groups.items()}
@@ -0,0 +1,248 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS attributes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id INTEGER NOT NULL UNIQUE,
+    event_id INTEGER,
+    type TEXT,
+    category TEXT,
+    value1 TEXT,
+    value2 TEXT,
+    to_ids INTEGER,
+    timestamp INTEGER,
+    tags TEXT,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS attributes_value1 ON attributes (value1);
+CREATE INDEX IF NOT EXISTS attributes_value2 ON attributes (value2);
+CREATE INDEX IF NOT EXISTS attributes_type ON attributes (type);
+CREATE INDEX IF NOT EXISTS attributes_event_id ON attributes (event_id);
+CREATE INDEX IF NOT EXISTS attributes_timestamp ON attributes (timestamp);
+CREATE TABLE IF NOT EXISTS stanzas (
+    name TEXT PRIMARY KEY,
+    earliest_timestamp INTEGER NOT NULL,
+    updated INTEGER NOT NULL
+);
+'''
+
+# stanzas which did not prune the store for this amount of seconds (e.g. deleted
+# inputs) do not hold back the pruning of the other stanzas
+STANZA_EXPIRY = 30 * 24 * 60 * 60
+
+_store_name = re.compile(r'[^a-zA-Z0-9_.-]')
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+def store_file_name(account_name):
+    return _store_name.sub('_', account_name)
+
+
+class IOCStore:
+    """
+    Local SQLite mirror of the attributes of a MISP account, maintained by the indicator
+    input and queried by mispsearchattributes source=local.
+
+    Each attribute is stored once by its id (a newer version replaces the older one and
+    gets a new seq), the attribute JSON as sent by MISP is kept in data. Composite values
+    (e.g. domain|ip) are split into value1 and value2 like MISP does, both are indexed.
+    If bloom_filter is set, the values of added attributes are also added to it.
+    """
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.bloom_filter = None
+        if readonly:
+            if not os.path.exists(path):
+                raise Exception(f"IOC store {path} does not exist, enable the IOC store of an indicator input of this account")
+            self.connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            # readers (searches) are not blocked while an input writes
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.executescript(SCHEMA)
+        self.connection.row_factory = sqlite3.Row
+
+    @classmethod
+    def for_account(cls, state_dir, account_name, readonly=False):
+        return cls(os.path.join(state_dir, 'ioc_store', store_file_name(account_name) + '.db'), readonly)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def split_value(attribute):
+        value = attribute.get('value', '')
+        if '|' in attribute.get('type', '') and '|' in value:
+            value1, value2 = value.split('|', 1)
+            return value1, value2
+        return value, None
+
+    def add_attributes(self, attributes):
+        """
+        Adds or replaces attributes, attributes are dicts or (dict, json_text) tuples
+        """
+        rows = []
+        for attribute in attributes:
+            if isinstance(attribute, tuple):
+                attribute, data = attribute
+            else:
+                data = _encoder.encode(attribute)
+            value1, value2 = self.split_value(attribute)
+            tags = [tag['name'] for tag in attribute.get('Tag') or [] if 'name' in tag]
+            rows.append((
+                int(attribute['id']),
+                int(attribute['event_id']),
+                attribute.get('type'),
+                attribute.get('category'),
+                value1,
+                value2,
+                1 if attribute.get('to_ids') else 0,
+                int(attribute['timestamp']),
+                _encoder.encode(tags),
+                data
+            ))
+        if not rows:
+            return 0
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO attributes (id, event_id, type, category, value1, value2, to_ids, timestamp, tags, data) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            if self.bloom_filter is not None:
+                # each added row got the next seq, so the rows have the seqs up to last_seq
+                last_seq = self.connection.execute('SELECT MAX(seq) FROM attributes').fetchone()[0]
+                self.bloom_filter.add_attributes(
+                    ((row[2] or '', row[4] if row[5] is None else f'{row[4]}|{row[5]}') for row in rows),
+                    last_seq - len(rows) + 1,
+                    last_seq
+                )
+        return len(rows)
+
+    def prune(self, stanza, earliest_timestamp, now=None):
+        """
+        Records the start of the import period of an input stanza and removes the attributes
+        which are older than the import periods of all stanzas of the store, so a stanza with
+        a short period does not remove attributes of a stanza with a longer one
+        """
+        now = int(now if now is not None else time.time())
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO stanzas (name, earliest_timestamp, updated) VALUES (?, ?, ?)',
+                (stanza, int(earliest_timestamp), now)
+            )
+            self.connection.execute('DELETE FROM stanzas WHERE updated < ?', (now - STANZA_EXPIRY,))
+            before_timestamp = self.connection.execute('SELECT MIN(earliest_timestamp) FROM stanzas').fetchone()[0]
+            if not before_timestamp:
+                return 0
+            return self.connection.execute('DELETE FROM attributes WHERE timestamp < ?', (before_timestamp,)).rowcount
+
+    def search(self, value=None, types=None, event_id=None, to_ids=None, timestamp=None, include_tags=None, exclude_tags=None, limit=None, order='timestamp ASC'):
+        """
+        Yields the stored attributes matching the filters, value may contain % wildcards
+        and matches either part of composite values
+        """
+        conditions = []
+        parameters = []
+        if value:
+            operator = 'LIKE' if '%' in value else '='
+            value_conditions = [f'value1 {operator} ?', f'value2 {operator} ?']
+            parameters.extend([value, value])
+            if '|' in value and operator == '=':
+                value_conditions.append('(value1 = ? AND value2 = ?)')
+                parameters.extend(value.split('|', 1))
+            conditions.append('(' + ' OR '.join(value_conditions) + ')')
+        if types:
+            types = types.split(',')
+            conditions.append('type IN (' + ','.join('?' * len(types)) + ')')
+            parameters.extend(types)
+        if event_id:
+            conditions.append('event_id = ?')
+            parameters.append(int(event_id))
+        if to_ids:
+            conditions.append('to_ids = 1')
+        if timestamp:
+            conditions.append('timestamp >= ?')
+            parameters.append(int(timestamp))
+
+        query = 'SELECT tags, data FROM attributes'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        if order == 'timestamp ASC':
+            query += ' ORDER BY timestamp, id'
+        elif order == 'timestamp DESC':
+            query += ' ORDER BY timestamp DESC, id DESC'
+
+        include_tags = set(include_tags.split(',')) if include_tags else None
+        exclude_tags = set(exclude_tags.split(',')) if exclude_tags else None
+        if limit is not None and not include_tags and not exclude_tags:
+            query += ' LIMIT ?'
+            parameters.append(int(limit))
+
+        count = 0
+        with self.lock:
+            cursor = self.connection.execute(query, parameters)
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(1000)
+            if not rows:
+                return
+            for row in rows:
+                if include_tags or exclude_tags:
+                    tags = set(json.loads(row['tags']))
+                    if include_tags and not tags & include_tags:
+                        continue
+                    if exclude_tags and tags & exclude_tags:
+                        continue
+                yield json.loads(row['data'])
+                count += 1
+                if limit is not None and count >= limit:
+                    cursor.close()
+                    return
+
+    def iter_values(self):
+        """
+        Yields (type, value) of all stored attributes
+        """
+        with self.lock:
+            cursor = self.connection.execute('SELECT type, value1, value2 FROM attributes')
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(10000)
+            if not rows:
+                return
+            for misp_type, value1, value2 in rows:
+                yield misp_type, value1 if value2 is None else f'{value1}|{value2}'
+
+    def iter_since(self, seq):
+        """
+        Yields (seq, attribute) of the attributes added or replaced after seq, ordered by seq
+        """
+        with self.lock:
+            cursor = self.connection.execute('SELECT seq, data FROM attributes WHERE seq > ? ORDER BY seq', (seq,))
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(1000)
+            if not rows:
+                return
+            for row_seq, data in rows:
+                yield row_seq, json.loads(data)
+
+    def get_stats(self):
+        with self.lock:
+            count, max_seq = self.connection.execute('SELECT COUNT(*), MAX(seq) FROM attributes').fetchone()
+        return {'ioc_store_attributes': count, 'ioc_store_seq': max_seq or 0}
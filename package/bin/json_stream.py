@@ -0,0 +1,117 @@
+import codecs
+import json
+import re
+
+CHUNK_SIZE = 64 * 1024
+
+# if the beginning of a document does not match the expected layout within
+# this amount of characters, the whole document is decoded at once
+MAX_PREFIX_LENGTH = 4096
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+def _prefix_pattern(path):
+    """
+    Builds a regex matching the beginning of a document up to the opening bracket
+    of the array at path, e.g. ('response', 'Attribute') matches '{"response": {"Attribute": ['
+    """
+    pattern = r'\s*'
+    for key in path:
+        pattern += r'\{\s*' + re.escape(json.dumps(key)) + r'\s*:\s*'
+    return re.compile(pattern + r'\[')
+
+
+def iter_json_array(chunks, path, raw=False):
+    """
+    Incrementally decodes the items of the JSON array at path from an iterable of
+    byte chunks, so only the current item and one chunk are held in memory.
+    Documents with another layout are decoded at once, an Exception with the decoded
+    document is raised if it has no array at path (e.g. error messages).
+    If raw is set, (item, json_text) tuples are yielded, json_text is the unmodified
+    text of the item in the document.
+    """
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer = ''
+    exhausted = False
+
+    def read():
+        nonlocal buffer, exhausted
+        for chunk in chunks:
+            text = text_decoder.decode(chunk)
+            if text:
+                buffer += text
+                return True
+        buffer += text_decoder.decode(b'', final=True)
+        exhausted = True
+        return False
+
+    # find the beginning of the array
+    prefix = _prefix_pattern(path)
+    match = prefix.match(buffer)
+    while not match and not exhausted and len(buffer) < MAX_PREFIX_LENGTH:
+        read()
+        match = prefix.match(buffer)
+
+    if not match:
+        while read():
+            pass
+        # like the checks of unstreamed responses, documents without the array at
+        # path (e.g. error messages sent with status 200) are raised
+        document = json.loads(buffer)
+        items = document
+        for key in path:
+            if not isinstance(items, dict) or key not in items:
+                raise Exception(document)
+            items = items[key]
+        if not isinstance(items, list):
+            raise Exception(document)
+        for item in items:
+            yield (item, json.dumps(item, ensure_ascii=False)) if raw else item
+        return
+
+    position = match.end()
+    while True:
+        position = _whitespace.match(buffer, position).end()
+        if position == len(buffer):
+            buffer = ''
+            position = 0
+            if not read():
+                raise ValueError('Unexpected end of JSON document')
+            continue
+
+        if buffer[position] == ']':
+            break
+        if buffer[position] == ',':
+            position += 1
+            continue
+
+        try:
+            item, end = _decoder.raw_decode(buffer, position)
+            complete = end < len(buffer) or exhausted
+        except json.JSONDecodeError:
+            if exhausted:
+                raise
+            complete = False
+
+        if not complete:
+            # item is not complete yet, read at least as much again as already
+            # buffered to keep re-decoding of large items linear
+            buffer = buffer[position:]
+            position = 0
+            target_length = 2 * len(buffer)
+            while read() and len(buffer) < target_length:
+                pass
+            continue
+
+        yield (item, buffer[position:end]) if raw else item
+        position = end
+        if position > CHUNK_SIZE:
+            buffer = buffer[position:]
+            position = 0
+
+    # consume the rest of the document, so the connection can be reused
+    while read():
+        pass
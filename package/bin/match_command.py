@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import import_declare_test
+
+import sys
+import os
+import glob
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib"))
+
+from splunklib.searchcommands import \
+    dispatch, StreamingCommand, Configuration, Option, validators
+
+from ioc_snapshot import IOCSnapshot, SNAPSHOT_DIR, SNAPSHOT_PREFIX, SNAPSHOT_SUFFIX, snapshot_path
+
+# amount of memoized values per search process
+MAX_MEMOIZED_VALUES = 100000
+
+@Configuration(distributed=True)
+class MISPMatchCommand(StreamingCommand):
+    """ Matches the values of a field against the IOC snapshots of the MISP instances.
+
+    ##Syntax
+    -- code-block::
+    | mispmatch field=<field> (misp_instance=<string>)? (groups=<string>)? (matches_only=(t|f))?
+
+    ##Description
+    The snapshots are built by the indicator inputs (IOC Snapshot setting) and distributed with the
+    knowledge bundle, so matching runs on the search peers. Matching events get the fields
+    misp_ioc_group (ip, domain, url, email or hash) and misp_ioc_instance.
+    """
+
+    field = Option(
+        doc='''
+        **Syntax:** **field=<field>*
+        **Description:** Field which holds the values to match, may be a multivalue field
+        ''',
+        require=True,
+        validate=validators.Fieldname()
+    )
+
+    misp_instance = Option(
+        doc='''
+        **Syntax:** **misp_instance=InstanceName*
+        **Description:** Name of the Instance whose snapshot is used, the snapshots of all instances are used if it is not provided
+        ''',
+        require=False,
+        default=None
+    )
+
+    groups = Option(
+        doc='''
+        **Syntax:** **groups=<string>,<string>,...*
+        **Description:** IOC groups to match, e.g.: \"ip,domain\" (ip, domain, url, email, hash)
+        ''',
+        require=False,
+        validate=validators.Match("groups", r"^[a-z,]+$")
+    )
+
+    matches_only = Option(
+        doc='''
+        **Syntax:** *matches_only=<1|y|Y|t|true|True|0|n|N|f|false|False>*
+        **Description:** Only return events with a matching value
+        **Default:** False
+        ''',
+        require=False,
+        default=False,
+        validate=validators.Boolean()
+    )
+
+    snapshots = None
+    groups_list = None
+    matches = None
+
+    def load_snapshots(self):
+        if self.misp_instance:
+            paths = [snapshot_path(self.misp_instance)]
+            if not os.path.exists(paths[0]):
+                raise Exception(f'No IOC snapshot for instance {self.misp_instance}, enable the IOC Snapshot of an indicator input of this instance')
+        else:
+            paths = sorted(glob.glob(os.path.join(SNAPSHOT_DIR, f'{SNAPSHOT_PREFIX}*{SNAPSHOT_SUFFIX}')))
+        self.snapshots = [
+            (os.path.basename(path)[len(SNAPSHOT_PREFIX):-len(SNAPSHOT_SUFFIX)], IOCSnapshot(path))
+            for path in paths
+        ]
+        self.matches = {}
+
+    def match(self, value):
+        # returns (groups, instances) of the value
+        result = self.matches.get(value)
+        if result is None:
+            groups = []
+            instances = []
+            for instance, snapshot in self.snapshots:
+                instance_groups = snapshot.match(value, self.groups_list)
+                if instance_groups:
+                    instances.append(instance)
+                    groups.extend(group for group in instance_groups if group not in groups)
+            result = (groups, instances)
+            if len(self.matches) >= MAX_MEMOIZED_VALUES:
+                self.matches.clear()
+            self.matches[value] = result
+        return result
+
+    def stream(self, records):
+        if self.snapshots is None:
+            self.groups_list = self.groups.split(',') if self.groups else None
+            self.load_snapshots()
+
+        for record in records:
+            values = record.get(self.field)
+            if not isinstance(values, list):
+                values = [values] if values else []
+
+            groups = []
+            instances = []
+            for value in values:
+                if not value:
+                    continue
+                value_groups, value_instances = self.match(value)
+                groups.extend(group for group in value_groups if group not in groups)
+                instances.extend(instance for instance in value_instances if instance not in instances)
+
+            if self.matches_only and not groups:
+                continue
+            # the fields are set on all events, as the fields of a chunk are set by its first event
+            self.add_field(record, 'misp_ioc_group', (groups[0] if len(groups) == 1 else groups) or None)
+            self.add_field(record, 'misp_ioc_instance', (instances[0] if len(instances) == 1 else instances) or None)
+            yield record
+
+
+dispatch(MISPMatchCommand, sys.argv, sys.stdin, sys.stdout, __name__)
@@ -1,17 +1,91 @@
 import json
 import requests
+import requests.adapters
 import re
-from datetime import datetime
-from functools import reduce
+import math
+import time
+import random
+import logging
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+
+from solnlib import log
+
+from splunk_generic import get_bool_val, get_state_dir
+from request_limiter import RequestLimiter
+from json_stream import iter_json_array, CHUNK_SIZE
+
+# transient responses of a loaded MISP or its front-end which are retried
+RETRY_STATUS_CODES = frozenset([429, 502, 503, 504])
+# requests which are not idempotent (e.g. adding a sighting) are only retried if MISP
+# did not process them: rejected responses and connections which were not established
+NON_IDEMPOTENT_RETRY_STATUS_CODES = frozenset([429, 503])
+RETRY_BACKOFF_BASE = 1.0
 
 class MISPHTTPClient:
-    def __init__(self, misp_url, auth_key, verify_ssl, proxies) -> None:
+    def __init__(self, misp_url, auth_key, verify_ssl, proxies, pool_size=10,
+                 retry_max=3, retry_backoff_max=60.0, retry_budget=20, circuit_breaker_threshold=5, circuit_breaker_cooldown=60.0,
+                 limiter=None, logger=None) -> None:
         self.misp_url = misp_url
         self.auth_key = auth_key
         self.verify_ssl = verify_ssl
         self.proxies = proxies
+        self.logger = logger
+
+        # transient errors are retried with exponential backoff, each endpoint may use up
+        # to retry_budget retries during the lifetime of the client
+        self.retry_max = retry_max
+        self.retry_backoff_max = retry_backoff_max
+        self.retry_budget = retry_budget
+        self.retry_budgets = {}
+        # retry budgets and stats are shared by the worker threads of an input
+        self.lock = threading.Lock()
+        self.circuit_breaker = CircuitBreaker.for_instance(misp_url, circuit_breaker_threshold, circuit_breaker_cooldown)
+        # concurrency and rate of requests to the instance shared with other processes
+        self.limiter = limiter if limiter and limiter.enabled else None
+        # optional ResponseCache for responses which are not streamed
+        self.cache = None
+
+        # one long-lived session per client, so TCP/TLS connections are kept alive
+        # and reused for all pages of a run instead of a new handshake per request
+        self.session = requests.Session()
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+        # request stats
+        self.request_count = 0
+        self.retry_count = 0
+
+    @classmethod
+    def from_account(cls, account, proxies, logger=None, interactive=False):
+        return cls(
+            account.get('misp_url', None),
+            account.get('auth_key'),
+            get_bool_val(account.get('tls_verify')),
+            proxies,
+            pool_size=int(account.get('request_pool_size', 10)),
+            retry_max=int(account.get('retry_max', 3)),
+            retry_backoff_max=float(account.get('retry_backoff_max', 60)),
+            retry_budget=int(account.get('retry_budget', 20)),
+            circuit_breaker_threshold=int(account.get('circuit_breaker_threshold', 5)),
+            circuit_breaker_cooldown=float(account.get('circuit_breaker_cooldown', 60)),
+            limiter=RequestLimiter.from_account(get_state_dir(), account, interactive),
+            logger=logger
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-    def _perform_request(self, method, endpoint, **kwargs):
+    def close(self):
+        self.session.close()
+
+    def _perform_request(self, method, endpoint, stream_path=None, raw_items=False, idempotent=True, **kwargs):
         headers = {
             'Authorization': self.auth_key,
             'Accept': 'application/json'
@@ -24,23 +98,173 @@ class MISPHTTPClient:
             endpoint = f"/{endpoint}"
         url = self.misp_url + '/' + endpoint
 
-        request_function = getattr(requests, method)
-        try:
-            response = request_function(
-                url,
-                headers=headers,
-                verify=self.verify_ssl,
-                proxies = self.proxies,
-                **kwargs
-            )
-        except Exception as e:
-            raise e
+        cache_key = None
+        if self.cache is not None and stream_path is None:
+            cache_key = self.cache.key(self.misp_url, self.auth_key, method, endpoint, kwargs.get('data'))
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                cached_headers, body, response_stats = cached
+                data = json.loads(body)
+                data['headers'] = cached_headers
+                data['response_stats'] = response_stats
+                return data
+
+        retry_status_codes = RETRY_STATUS_CODES if idempotent else NON_IDEMPOTENT_RETRY_STATUS_CODES
+        attempt = 0
+        while True:
+            self.circuit_breaker.before_request()
+            slot = self.limiter.acquire() if self.limiter else None
+            started = time.perf_counter()
+            try:
+                response = self.session.request(
+                    method,
+                    url,
+                    headers=headers,
+                    verify=self.verify_ssl,
+                    proxies = self.proxies,
+                    stream = stream_path is not None,
+                    **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._release(slot)
+                with self.lock:
+                    self.request_count += 1
+                self.circuit_breaker.record_failure()
+                retryable = idempotent or isinstance(e, requests.ConnectTimeout)
+                if not retryable or not self._wait_for_retry(endpoint, attempt, repr(e)):
+                    raise e
+                attempt += 1
+                continue
+            except BaseException:
+                self._release(slot)
+                raise
+            with self.lock:
+                self.request_count += 1
+
+            if response.status_code in retry_status_codes:
+                self.circuit_breaker.record_failure()
+                retry_after = self._parse_retry_after(response.headers.get('Retry-After'))
+                self._release(slot)
+                slot = None
+                if self._wait_for_retry(endpoint, attempt, f"HTTP Status: {response.status_code}", retry_after):
+                    response.close()
+                    attempt += 1
+                    continue
+            elif response.status_code < 500:
+                self.circuit_breaker.record_success()
+            break
         
         if response.status_code > 299:
+            self._release(slot)
             raise Exception(f"HTTP Status: {response.status_code}, Content: {response.text}, Data: {json.dumps(kwargs.get('data', ''))}")
-        data = response.json()
+
+        # duration until the response is received (until the headers are received if it is
+        # streamed) and size of the body, which is only known once a streamed body is consumed
+        response_stats = {'seconds': 0.0, 'bytes': 0}
+        if stream_path is not None:
+            response_stats['seconds'] = response.elapsed.total_seconds()
+            # MISP renders the whole result before it is sent, so the request does not count
+            # as running for the limiter while the body is received
+            self._release(slot)
+            # the items at stream_path are decoded while the body is received
+            data = self._iter_response_items(response, stream_path, raw_items, response_stats)
+            for key in reversed(stream_path):
+                data = {key: data}
+        else:
+            response_stats['seconds'] = time.perf_counter() - started
+            try:
+                response_stats['bytes'] = len(response.content)
+            finally:
+                self._release(slot)
+            data = response.json()
+            if cache_key is not None:
+                self.cache.put(cache_key, dict(response.headers), response.content, response_stats)
         data['headers'] = dict(response.headers)
+        data['response_stats'] = response_stats
         return data
+
+    def _release(self, slot):
+        if self.limiter:
+            self.limiter.release(slot)
+
+    def _wait_for_retry(self, endpoint, attempt, reason, retry_after=None):
+        # returns False if the request must not be retried, otherwise waits until it may be
+        if retry_after is not None:
+            if retry_after > self.retry_backoff_max:
+                return False
+            delay = retry_after
+        else:
+            # exponential backoff with full jitter
+            delay = random.uniform(0, min(self.retry_backoff_max, RETRY_BACKOFF_BASE * 2 ** attempt))
+
+        with self.lock:
+            budget = self.retry_budgets.get(endpoint, self.retry_budget)
+            if attempt >= self.retry_max or budget <= 0:
+                return False
+            self.retry_budgets[endpoint] = budget - 1
+            self.retry_count += 1
+        if self.logger:
+            log.log_event(self.logger, {
+                'Action': 'retry request',
+                'endpoint': endpoint,
+                'reason': reason,
+                'attempt': attempt + 1,
+                'delay': round(delay, 3),
+                'retry_budget': budget - 1
+            }, logging.WARNING)
+        time.sleep(delay)
+        return True
+
+    @staticmethod
+    def _parse_retry_after(value):
+        # Retry-After is either an amount of seconds or a HTTP date
+        if not value:
+            return None
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if retry_at.tzinfo is None:
+            retry_at = retry_at.replace(tzinfo=timezone.utc)
+        return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+    @staticmethod
+    def _iter_response_items(response, path, raw_items=False, response_stats=None):
+        def count_bytes(chunks):
+            for chunk in chunks:
+                response_stats['bytes'] += len(chunk)
+                yield chunk
+
+        chunks = response.iter_content(chunk_size=CHUNK_SIZE)
+        if response_stats is not None:
+            chunks = count_bytes(chunks)
+        try:
+            yield from iter_json_array(chunks, path, raw_items)
+        finally:
+            response.close()
+
+    def get_stats(self):
+        # every pool (direct or via proxy) counts the connections it had to open,
+        # all other requests were served by a kept-alive connection
+        pool_managers = [self.adapter.poolmanager] + list(self.adapter.proxy_manager.values())
+        connection_count = 0
+        for pool_manager in pool_managers:
+            for pool_key in pool_manager.pools.keys():
+                pool = pool_manager.pools.get(pool_key)
+                if pool is not None:
+                    connection_count += pool.num_connections
+        return {
+            'request_count': self.request_count,
+            'retry_count': self.retry_count,
+            'limiter_wait_seconds': round(self.limiter.wait_seconds, 3) if self.limiter else 0.0,
+            **(self.cache.get_stats() if self.cache is not None else {}),
+            'connection_count': connection_count,
+            'reused_connection_count': max(self.request_count - connection_count, 0)
+        }
     
 
     def check_connectivity(self):
@@ -57,6 +281,7 @@ class MISPHTTPClient:
         result = self._perform_request(
             method='post',
             endpoint='sightings/add',
+            idempotent=False,
             data=json.dumps(request_body)
         )
         if 'Sighting' in result:
@@ -65,7 +290,7 @@ class MISPHTTPClient:
             raise Exception(result)
 
 
-    def get_events(self, limit, page, published=True, metadata=True, order="publish_timestamp", timestamp=None, publish_timestamp=None, include_context=False, event_id=None, value=None):
+    def get_events(self, limit, page, published=True, metadata=True, order="publish_timestamp", timestamp=None, publish_timestamp=None, include_context=False, event_id=None, value=None, stream=False):
         request_body = {
             "page": page,
             "limit": limit,
@@ -82,6 +307,7 @@ class MISPHTTPClient:
         result = self._perform_request(
             method='post',
             endpoint='/events/restSearch',
+            stream_path=('response',) if stream else None,
             data=json.dumps(request_body)
         )
 
@@ -106,8 +332,12 @@ class MISPHTTPClient:
             exclude_tags="",
             value=None,
             order=None,
-            last=None
+            last=None,
+            stream=False,
+            raw_items=False
             ):
+        # with raw_items the response is streamed and the attributes are
+        # (attribute, json_text) tuples, json_text is the attribute as sent by MISP
         request_body = {
             'page': page,
             'limit': limit,
@@ -137,6 +367,8 @@ class MISPHTTPClient:
         result = self._perform_request(
             method='post',
             endpoint='/attributes/restSearch',
+            stream_path=('response', 'Attribute') if stream or raw_items else None,
+            raw_items=raw_items,
             data=json.dumps(request_body)
         )
 
@@ -218,114 +450,443 @@ class MISPHTTPClient:
             raise Exception(result)
 
 
+    def iter_attribute_pages(self, limit, cursor=None, raw_items=False, page_sizer=None, **kwargs):
+        # cursor (keyset) pagination, see KeysetPager
+        return KeysetPager(self, limit, cursor, raw_items, page_sizer, **kwargs)
+
     @staticmethod
-    def map_attribute(attribute_dict, prefix="misp_"):
-        mapping = {
-            'category': 'category',
-            'comment': 'comment',
-            'distribution': 'attribute_distribution',
-            'event_id': 'event_id',
-            'event_uuid': 'event_uuid',
-            'id': 'attribute_id',
-            'object_id': 'object_id',
-            'object_relation': 'object_relation',
-            'sharing_group_id': 'sharing_group_id',
-            'timestamp': 'timestamp',
-            'to_ids': 'to_ids',
-            'type': 'type',
-            'value': 'value',
-            'Event.distribution': 'event_distribution',
-            'Event.id': 'event_id',
-            'Event.info': 'event_info',
-            'Event.org_id': 'org_id',
-            'Event.orgc_id': 'orgc_id',
-            'Event.uuid': 'event_uuid',
-            'deleted': 'deleted',
-            'first_seen': 'first_seen',
-            'Event.Orgc.name': 'event_orgc_name',
-            'Event.Orgc.uuid': 'event_orgc_uuid',
-            'Event.analysis': 'event_analysis',
-            'Event.date': 'event_date',
-            'Event.timestamp': 'event_timestamp',
-            'Event.publish_timestamp': 'event_publish_timestamp',
-            'Event.published': 'event_published',
-            'Event.threat_level_id': 'event_threat_level'
-        }
+    @lru_cache(maxsize=None)
+    def get_attribute_mapper(prefix="misp_"):
+        return FieldMapper(ATTRIBUTE_FIELD_MAPPING, prefix, map_types=True)
 
-        attribute = dict()
-        for key, value in mapping.items():
-            try:
-                attribute[f'{prefix}{value}'] = reduce(lambda acc,i: acc[i], key.split('.'), attribute_dict)
-            except:
-                pass
-                #attribute[f'{prefix}{value}'] = None
-
-        if 'Tag' in attribute_dict:
-            if isinstance(attribute_dict['Tag'], list):
-                attribute[f'{prefix}tag'] = list()
-                for tag in attribute_dict.get('Tag', []):
-                    attribute[f'{prefix}tag'].append(tag['name'].strip())
-            elif isinstance(attribute_dict['Tag'], dict):
-                attribute[f'{prefix}tag'] = attribute_dict['Tag']['name'].strip()
-
-
-        hash_types = ['impfuzzy', 'imphash', 'md5', 'pehash', 'sha1', 'sha224', 'sha256', 'sha3-224', 'sha3-224', 'sha3-384', 'sha3-512', 'sha384', 'sha512', 'sha512/224', 'sha512/224', 'ssdeep', 'tlsh', 'vhash']
-        ip_types = ['ip', 'ip-dst', 'ip-src', ]
-        email_types = ['dns-soa-email', 'email', 'email-dst', 'email-src', 'email-replay-to', 'target-email', 'whois-registrant-email']
-        values = attribute_dict['value'].split('|')
-        types = attribute_dict['type'].split('|')
-        for value, misp_type in zip(values, types):
-            if misp_type in hash_types:
-                attribute[f'{prefix}hash'] = value
-            if misp_type in ip_types:
-                attribute[f'{prefix}ip'] = value
-            if misp_type in email_types:
-                attribute[f'{prefix}email'] = value
-            misp_type = misp_type.replace('-', '_')
-            attribute[f'{prefix}{misp_type}'] = value
-           
-        return attribute
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def get_event_mapper(prefix="misp_"):
+        return FieldMapper(EVENT_FIELD_MAPPING, prefix, map_types=False)
 
+    @staticmethod
+    def map_attribute(attribute_dict, prefix="misp_"):
+        return MISPHTTPClient.get_attribute_mapper(prefix).map(attribute_dict)
 
     @staticmethod
     def map_event(event_dict, prefix="misp_"):
-        mapping = {
-                'id': 'event_id',
-                'orgc_id': 'orgc_id',
-                'org_id': 'org_id',
-                'date': 'event_date',
-                'threat_level_id': 'event_threat_level',
-                'info': 'event_info',
-                'published': 'event_published',
-                'uuid': 'event_uuid',
-                'attribute_count': 'event_attribute_count',
-                'analysis': 'event_analysis',
-                'timestamp': 'event_timestamp',
-                'distribution': 'event_distribution',
-                'publish_timestamp': 'event_publish_timestamp',
-                'sharing_group_id': 'misp_sharing_group_id',
-                'Org.name': 'event_org_name',
-                'Org.uuid': 'event_org_uuid',
-                'Orgc.name': 'event_orgc_name',
-                'Orgc.uuid': 'event_orgc_uuid',
-                'Galaxy': 'event_galaxy'
-            }
-        
-        event = dict()
-        for key, value in mapping.items():
-            try:
-                event[f'{prefix}{value}'] = reduce(lambda acc,i: acc[i], key.split('.'), event_dict)
-            except:
+        return MISPHTTPClient.get_event_mapper(prefix).map(event_dict)
+
+
+ATTRIBUTE_FIELD_MAPPING = {
+    'category': 'category',
+    'comment': 'comment',
+    'distribution': 'attribute_distribution',
+    'event_id': 'event_id',
+    'event_uuid': 'event_uuid',
+    'id': 'attribute_id',
+    'object_id': 'object_id',
+    'object_relation': 'object_relation',
+    'sharing_group_id': 'sharing_group_id',
+    'timestamp': 'timestamp',
+    'to_ids': 'to_ids',
+    'type': 'type',
+    'value': 'value',
+    'Event.distribution': 'event_distribution',
+    'Event.id': 'event_id',
+    'Event.info': 'event_info',
+    'Event.org_id': 'org_id',
+    'Event.orgc_id': 'orgc_id',
+    'Event.uuid': 'event_uuid',
+    'deleted': 'deleted',
+    'first_seen': 'first_seen',
+    'Event.Orgc.name': 'event_orgc_name',
+    'Event.Orgc.uuid': 'event_orgc_uuid',
+    'Event.analysis': 'event_analysis',
+    'Event.date': 'event_date',
+    'Event.timestamp': 'event_timestamp',
+    'Event.publish_timestamp': 'event_publish_timestamp',
+    'Event.published': 'event_published',
+    'Event.threat_level_id': 'event_threat_level'
+}
+
+EVENT_FIELD_MAPPING = {
+    'id': 'event_id',
+    'orgc_id': 'orgc_id',
+    'org_id': 'org_id',
+    'date': 'event_date',
+    'threat_level_id': 'event_threat_level',
+    'info': 'event_info',
+    'published': 'event_published',
+    'uuid': 'event_uuid',
+    'attribute_count': 'event_attribute_count',
+    'analysis': 'event_analysis',
+    'timestamp': 'event_timestamp',
+    'distribution': 'event_distribution',
+    'publish_timestamp': 'event_publish_timestamp',
+    'sharing_group_id': 'misp_sharing_group_id',
+    'Org.name': 'event_org_name',
+    'Org.uuid': 'event_org_uuid',
+    'Orgc.name': 'event_orgc_name',
+    'Orgc.uuid': 'event_orgc_uuid',
+    'Galaxy': 'event_galaxy'
+}
+
+HASH_TYPES = frozenset(['impfuzzy', 'imphash', 'md5', 'pehash', 'sha1', 'sha224', 'sha256', 'sha3-224', 'sha3-384', 'sha3-512', 'sha384', 'sha512', 'sha512/224', 'ssdeep', 'tlsh', 'vhash'])
+IP_TYPES = frozenset(['ip', 'ip-dst', 'ip-src'])
+EMAIL_TYPES = frozenset(['dns-soa-email', 'email', 'email-dst', 'email-src', 'email-replay-to', 'target-email', 'whois-registrant-email'])
+
+# types of the IOC lookups by group (see the MISP_TI_* reports), parts of composite
+# types (e.g. domain|ip) are grouped by their own type
+IOC_TYPE_GROUPS = {
+    'domain': frozenset(['domain', 'hostname']),
+    'email': EMAIL_TYPES,
+    'hash': HASH_TYPES,
+    'ip': IP_TYPES,
+    'url': frozenset(['link', 'uri', 'url']),
+}
+IOC_TYPE_GROUP_BY_TYPE = {misp_type: group for group, types in IOC_TYPE_GROUPS.items() for misp_type in types}
+
+
+def split_ioc_value(misp_type, value, default_group=None):
+    """
+    Returns the (group, value) pairs of an attribute value, composite values are split
+    and parts of types without group are in default_group or left out if it is None
+    """
+    if '|' in misp_type:
+        pairs = zip(misp_type.split('|'), value.split('|'))
+    else:
+        pairs = ((misp_type, value),)
+    if default_group is None:
+        return [(IOC_TYPE_GROUP_BY_TYPE[part_type], part) for part_type, part in pairs if part_type in IOC_TYPE_GROUP_BY_TYPE]
+    return [(IOC_TYPE_GROUP_BY_TYPE.get(part_type, default_group), part) for part_type, part in pairs]
+
+_MISSING = object()
+
+
+class FieldMapper:
+    """
+    Maps a MISP item (attribute or event) to a flat dict with prefixed field names.
+    Output field names and accessor paths are computed once per mapping and prefix,
+    so mapping an item only performs dict lookups.
+    """
+    def __init__(self, mapping, prefix, map_types):
+        self.accessors = tuple(
+            (f'{prefix}{value}', key.split('.')[0], tuple(key.split('.')[1:]))
+            for key, value in mapping.items()
+        )
+        self.prefix = prefix
+        self.tag_field = f'{prefix}tag'
+        self.map_types = map_types
+        self.type_fields = {}
+
+    def get_type_fields(self, misp_type):
+        # hash, ip and email types are additionally mapped to a generic field
+        type_fields = self.type_fields.get(misp_type)
+        if type_fields is None:
+            type_fields = []
+            if misp_type in HASH_TYPES:
+                type_fields.append(f'{self.prefix}hash')
+            if misp_type in IP_TYPES:
+                type_fields.append(f'{self.prefix}ip')
+            if misp_type in EMAIL_TYPES:
+                type_fields.append(f'{self.prefix}email')
+            type_fields.append(self.prefix + misp_type.replace('-', '_'))
+            type_fields = self.type_fields[misp_type] = tuple(type_fields)
+        return type_fields
+
+    def map(self, item, tags=_MISSING):
+        # tags replaces the Tag of the item, e.g. the tag of an expanded TagView
+        mapped = {}
+        get = item.get
+        for field, key, path in self.accessors:
+            value = get(key, _MISSING)
+            if value is _MISSING:
+                continue
+            if path:
+                try:
+                    for key in path:
+                        value = value[key]
+                except Exception:
+                    continue
+            mapped[field] = value
+
+        if tags is _MISSING:
+            tags = get('Tag', _MISSING)
+        if tags is not _MISSING:
+            if isinstance(tags, list):
+                mapped[self.tag_field] = [tag['name'].strip() for tag in tags]
+            elif isinstance(tags, dict):
+                mapped[self.tag_field] = tags['name'].strip()
+
+        if self.map_types:
+            value = item['value']
+            misp_type = item['type']
+            if '|' in value or '|' in misp_type:
+                pairs = zip(value.split('|'), misp_type.split('|'))
+            else:
+                pairs = ((value, misp_type),)
+            for value, misp_type in pairs:
+                for field in self.get_type_fields(misp_type):
+                    mapped[field] = value
+
+        return mapped
+
+
+class CircuitBreaker:
+    """
+    Fails requests to a MISP instance fast once threshold consecutive requests failed
+    (connection errors or transient status codes), until cooldown seconds have passed.
+    Afterwards requests are let through again, the next failure opens the breaker again.
+    There is one breaker per MISP url, shared by all clients of a process.
+    """
+    _breakers = {}
+    _breakers_lock = threading.Lock()
+
+    def __init__(self, name, threshold, cooldown):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+
+    @classmethod
+    def for_instance(cls, misp_url, threshold, cooldown):
+        with cls._breakers_lock:
+            breaker = cls._breakers.get(misp_url)
+            if breaker is None:
+                breaker = cls._breakers[misp_url] = cls(misp_url, threshold, cooldown)
+            breaker.threshold = threshold
+            breaker.cooldown = cooldown
+            return breaker
+
+    def before_request(self):
+        with self.lock:
+            if self.threshold <= 0 or self.opened_at is None:
+                return
+            remaining = self.opened_at + self.cooldown - time.monotonic()
+            if remaining > 0:
+                raise Exception(f"Circuit breaker open for {self.name} after {self.failures} consecutive failed requests, retry in {math.ceil(remaining)}s")
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.threshold > 0 and self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+
+class KeysetPager:
+    """
+    Pages through attributes ordered by timestamp. Each request asks for the attributes
+    at or after the highest timestamp seen so far, attributes with this timestamp which
+    were already returned are skipped. So every request has the cost of a first page,
+    instead of an OFFSET scan which grows with the page number.
+    Only while all attributes of a page share one timestamp, the next page is requested
+    by offset with the same timestamp filter (and the same skipped ids). With a page_sizer
+    the limit of the first page of a timestamp is at least the largest amount of attributes
+    seen with one timestamp plus the skipped ids, so small adaptive limits do not fall back
+    to many offset pages within a timestamp.
+
+    Iterating yields get_attributes results, the attributes of a page are filtered while
+    they are consumed. The cursor is valid for the next request once a page is consumed,
+    it is JSON serializable and can be passed to resume paging.
+    """
+    def __init__(self, misp_client, limit, cursor=None, raw_items=False, page_sizer=None, **kwargs):
+        self.misp_client = misp_client
+        self.limit = page_sizer.limit if page_sizer else limit
+        self.raw_items = raw_items
+        self.page_sizer = page_sizer
+        self.kwargs = kwargs
+        self.cursor = cursor or {
+            'timestamp': int(kwargs.get('timestamp') or 0),
+            'page': 1,
+            'seen_ids': []
+        }
+        self.kwargs.pop('timestamp', None)
+        self.kwargs.pop('order', None)
+        # pages after the first one of a timestamp are offset by the limit they were requested with
+        if 'limit' in self.cursor:
+            self.limit = self.cursor['limit']
+        # largest amount of attributes with one timestamp seen in a page
+        self.batch = 0
+        self.finished = False
+
+    def __iter__(self):
+        while True:
+            result = self.misp_client.get_attributes(
+                self.limit,
+                self.cursor['page'],
+                timestamp=self.cursor['timestamp'],
+                order='Attribute.timestamp ASC',
+                raw_items=self.raw_items,
+                **self.kwargs
+            )
+            attributes = self._filter(result['response'].get('Attribute', []), result)
+            if isinstance(result['response'].get('Attribute'), list):
+                attributes = list(attributes)
+            result['response']['Attribute'] = attributes
+            yield result
+
+            # the rest of a page which was not consumed is skipped
+            for _ in attributes:
                 pass
-                #event[f'{prefix}{value}'] = None
-
-        if 'Tag' in event_dict:
-            if isinstance(event_dict['Tag'], list):
-                event[f'{prefix}tag'] = list()
-                for tag in event_dict.get('Tag', []):
-                    event[f'{prefix}tag'].append(tag['name'].strip())
-            elif isinstance(event_dict['Tag'], dict):
-                event[f'{prefix}tag'] = event_dict['Tag']['name'].strip()
-
-        return event
+            if self.finished:
+                return
+
+    def _filter(self, attributes, result):
+        # the cursor is advanced as soon as all attributes of the page are consumed
+        page = {'count': 0, 'timestamp': None, 'ids': []}
+        seen_ids = set(self.cursor['seen_ids'])
+        cursor_timestamp = self.cursor['timestamp']
+        batch = self.batch
+        for item in attributes:
+            attribute = item[0] if self.raw_items else item
+            page['count'] += 1
+            timestamp = int(attribute['timestamp'])
+            if page['timestamp'] is None or timestamp > page['timestamp']:
+                page['timestamp'] = timestamp
+                page['ids'] = [attribute['id']]
+            elif timestamp == page['timestamp']:
+                page['ids'].append(attribute['id'])
+                if len(page['ids']) > batch:
+                    batch = len(page['ids'])
+
+            if timestamp == cursor_timestamp and attribute['id'] in seen_ids:
+                continue
+            yield item
+        self.batch = batch
+        self.finished = not self._advance(page, result['headers'])
+
+        if self.page_sizer:
+            self.page_sizer.observe(page['count'], result['response_stats'])
+            # within a timestamp pages are continued by offset, so the limit must not change
+            if self.cursor['page'] == 1:
+                self.limit = min(max(self.page_sizer.limit, self.batch) + len(self.cursor['seen_ids']), self.page_sizer.max_limit)
+
+    def _advance(self, page, headers):
+        # returns False if there are no more attributes
+        if 'X-Skipped-Elements-Count' in headers:
+            # MISP drops attributes (e.g. warninglists) after limit is applied
+            if page['count'] + int(headers['X-Skipped-Elements-Count']) < self.limit:
+                return False
+        elif page['count'] == 0:
+            return False
+
+        if page['timestamp'] is None or page['timestamp'] == self.cursor['timestamp']:
+            # the page did not get past the current timestamp
+            self.cursor = {
+                'timestamp': self.cursor['timestamp'],
+                'page': self.cursor['page'] + 1,
+                'seen_ids': self.cursor['seen_ids'],
+                'limit': self.limit
+            }
+        else:
+            self.cursor = {
+                'timestamp': page['timestamp'],
+                'page': 1,
+                'seen_ids': page['ids']
+            }
+        return True
+
+
+class PageSizer:
+    """
+    Adapts the page size (limit) of paged requests, so that a page takes about
+    target_seconds and target_bytes. The amount of items which meets both targets is
+    extrapolated from the last page, the limit grows at most by factor 2 per page.
+    With aligned set, pages are requested by offset: the limit is only doubled or halved
+    and only changed when the offset of the next page is a multiple of the new limit,
+    so page numbers (offset // limit + 1) stay valid.
+    """
+    def __init__(self, limit, min_limit, max_limit, target_seconds=10.0, target_bytes=20 * 1024 * 1024, aligned=True, logger=None, name='page'):
+        self.min_limit = max(int(min_limit), 1)
+        self.max_limit = max(int(max_limit), self.min_limit)
+        self.limit = min(max(int(limit), self.min_limit), self.max_limit)
+        self.target_seconds = target_seconds
+        self.target_bytes = target_bytes
+        self.aligned = aligned
+        self.logger = logger
+        self.name = name
+        self.offset = 0
+        self.limits = [self.limit]
+
+    @classmethod
+    def from_account(cls, account, limit, aligned=True, logger=None, name='page'):
+        # without adaptive page size the limit stays fixed
+        if not get_bool_val(account.get('adaptive_page_size', False)):
+            return cls(limit, limit, limit, aligned=aligned, logger=logger, name=name)
+        return cls(
+            limit,
+            int(account.get('page_size_min', 100)),
+            int(account.get('page_size_max', 10000)),
+            float(account.get('page_target_seconds', 10)),
+            float(account.get('page_target_mb', 20)) * 1024 * 1024,
+            aligned=aligned,
+            logger=logger,
+            name=name
+        )
 
+    @property
+    def page(self):
+        return self.offset // self.limit + 1
+
+    def start_at(self, offset):
+        # the limit must divide the offset of the first page, if the largest such limit
+        # is below min_limit, the first page starts at the aligned offset before the given
+        # one instead, so its first items are fetched again
+        if offset % self.limit:
+            limit = math.gcd(offset, self.limit)
+            if limit >= self.min_limit:
+                self.limit = limit
+                self.limits.append(limit)
+            else:
+                offset -= offset % self.limit
+        self.offset = offset
+
+    def observe(self, item_count, response_stats):
+        # called after each page with the amount of returned items
+        self.offset += self.limit
+        if self.min_limit == self.max_limit or item_count == 0:
+            return
+
+        ratios = []
+        if response_stats['seconds'] > 0:
+            ratios.append(self.target_seconds / response_stats['seconds'])
+        if response_stats['bytes'] > 0:
+            ratios.append(self.target_bytes / response_stats['bytes'])
+        if not ratios:
+            return
+        estimate = item_count * min(ratios)
+
+        limit = self.limit
+        if self.aligned:
+            if estimate >= limit * 2 and limit * 2 <= self.max_limit and self.offset % (limit * 2) == 0:
+                limit *= 2
+            while estimate < limit and limit // 2 >= self.min_limit and self.offset % (limit // 2) == 0:
+                limit //= 2
+        else:
+            limit = min(max(int(estimate), self.min_limit), self.max_limit, self.limit * 2)
+
+        if limit != self.limit:
+            if self.logger:
+                log.log_event(self.logger, {
+                    'Action': 'page size changed',
+                    'name': self.name,
+                    'limit': limit,
+                    'previous_limit': self.limit,
+                    'items': item_count,
+                    'seconds': round(response_stats['seconds'], 3),
+                    'bytes': response_stats['bytes']
+                }, logging.INFO)
+            self.limit = limit
+            self.limits.append(limit)
+
+    def get_stats(self):
+        return {
+            'name': self.name,
+            'limit': self.limit,
+            'min_used_limit': min(self.limits),
+            'max_used_limit': max(self.limits),
+            'limit_changes': len(self.limits) - 1
+        }
@@ -7,14 +7,15 @@ from splunklib import modularinput as smi
 import re
 import requests
 import math
+import threading
 from datetime import datetime, timedelta
 
 import splunk_generic
 from splunk_generic import get_bool_val
-from misp_client import MISPHTTPClient
+from misp_client import MISPHTTPClient, PageSizer
 from state_store import FileStateStore
 
-from input_utils import SplunkEventIngestor
+from input_utils import SplunkEventIngestor, run_stanzas, iter_tag_views
 
 ADDON_NAME = "TA_misp"
 
@@ -35,12 +36,7 @@ def validate_input(definition: smi.ValidationDefinition):
     if ignore_proxy:
         proxies = None
 
-    misp_client = MISPHTTPClient(
-        misp_url,
-        account['auth_key'],
-        get_bool_val(account['tls_verify']),
-        proxies
-    )
+    misp_client = MISPHTTPClient.from_account(account, proxies)
     result = misp_client.get_events(
             limit=1,
             page=0
@@ -50,6 +46,12 @@ def validate_input(definition: smi.ValidationDefinition):
     return
 
 
+def collect_event_keys(events, event_keys):
+    for event in events:
+        event_keys.append((event['Event']['id'], event['Event']['publish_timestamp']))
+        yield event
+
+
 def stream_events(inputs: smi.InputDefinition, event_writer: smi.EventWriter):
     # inputs.inputs is a Python dictionary object like:
     # {
@@ -64,8 +66,12 @@ def stream_events(inputs: smi.InputDefinition, event_writer: smi.EventWriter):
     # }
     session_key = inputs.metadata["session_key"]
     proxies = splunk_generic.get_proxy_config(session_key)
+    input_workers = int(splunk_generic.get_global_config(session_key).get('input_workers', 4))
+
+    # the ingestors of all stanzas write to the same event writer
+    writer_lock = threading.Lock()
 
-    for input_name, input_item in inputs.inputs.items():
+    def ingest_stanza(input_name, input_item):
         normalized_input_name = input_name.split("/")[-1]
 
         state_store = FileStateStore(
@@ -92,9 +98,11 @@ def stream_events(inputs: smi.InputDefinition, event_writer: smi.EventWriter):
             normalize_field_names = get_bool_val(input_item.get('normalize_field_names', True))
             normalized_field_prefix = input_item.get('normalized_field_prefix', "misp_")
             expand_tags = get_bool_val(input_item.get('expand_tags', False))
+            stream_responses = get_bool_val(input_item.get('stream_responses', False))
+            event_batch_size = int(input_item.get('event_batch_size', 500))
 
-            if ignore_proxy:
-                proxies = None
+            # each stanza uses the proxy settings of its own account
+            account_proxies = None if ignore_proxy else proxies
 
             # time conversation
             input_duration = input_item.get('import_period', '180d')
@@ -112,12 +120,7 @@ def stream_events(inputs: smi.InputDefinition, event_writer: smi.EventWriter):
                 earliest_timestamp = int(earliest_timestamp.timestamp())
 
             # initialize MISP CLient
-            misp_client = MISPHTTPClient(
-                misp_url,
-                account['auth_key'],
-                get_bool_val(account['tls_verify']),
-                proxies
-            )
+            misp_client = MISPHTTPClient.from_account(account, account_proxies, logger)
 
             log.log_event(logger, {'Action': 'override', 'override_timestamps': override_timestamps, 'input_item': input_item, 'account': account}, logging.DEBUG)
 
@@ -126,10 +129,13 @@ def stream_events(inputs: smi.InputDefinition, event_writer: smi.EventWriter):
                 input_item.get('index'),
                 misp_url.split('/')[-1],
                 input_item.get('sourcetype'),
-                override_timestamps            
+                override_timestamps,
+                batch_size=event_batch_size,
+                lock=writer_lock
             )
 
             # continuous importing
+            state = None
             if continuous_importing:
                 # initialize state
                 state = state_store.get_state()
@@ -142,53 +148,52 @@ def stream_events(inputs: smi.InputDefinition, event_writer: smi.EventWriter):
             log.log_event(logger, state, logging.INFO)
 
             # pull events in 1000 event batches
+            page_sizer = PageSizer.from_account(account, request_event_limit, True, logger, 'events')
             for i in range(0, max_requests):
-                page = i+1
-                events = misp_client.get_events(
-                    limit=request_event_limit,
-                    page=page,
+                # id and publish timestamp of each event are collected while the
+                # (possibly streamed) events are ingested to update the state afterwards
+                page_events = []
+                result = misp_client.get_events(
+                    limit=page_sizer.limit,
+                    page=page_sizer.page,
                     publish_timestamp=state['publish_timestamp'],
                     #include_context=include_context,
                     #published=get_bool_val(input_item.get('published', True))
-                )['response']
+                    stream=stream_responses
+                )
+                events = collect_event_keys(result['response'], page_events)
 
                 if normalize_field_names:
-                    mapping_function=lambda x:MISPHTTPClient.map_event(x, normalized_field_prefix)
+                    mapping_function=MISPHTTPClient.get_event_mapper(normalized_field_prefix).map
                 else:
                     mapping_function=lambda x:x
 
+                extract_function = lambda x:x['Event']
                 if expand_tags:
-                    expanded_events = []
-                    for event in events:
-                        event = event['Event']
-                        if 'Tag' not in event:
-                            event['Tag'] = []
-
-                        if len(event['Tag']) >= 1:
-                            for tag in event['Tag']:
-                                expanded_event = event.copy()
-                                expanded_event['Tag'] = tag
-                                expanded_events.append({'Event': expanded_event})
-                        else:
-                            expanded_event = event.copy()
-                            expanded_event['Tag'] = None
-                            expanded_events.append({'Event': expanded_event})
-                    events = expanded_events
+                    events = iter_tag_views(events, extract_function)
+                    extract_function = lambda x:x
+                    if normalize_field_names:
+                        # the event is mapped directly instead of through its view
+                        mapper = MISPHTTPClient.get_event_mapper(normalized_field_prefix)
+                        mapping_function = lambda x:mapper.map(x.item, x.tag)
 
                 event_ingestor.ingest_items(
                     events,
-                    extract_function=lambda x:x['Event'],
+                    extract_function=extract_function,
                     mapping_function=mapping_function,
                     skip_check=lambda x:x['id'] in state['ts_imported_events'] and int(x['publish_timestamp']) == state['publish_timestamp']
                 )
+                page_sizer.observe(len(page_events), result['response_stats'])
 
                 # Update state
-                if continuous_importing and len(events) > 0:
-                    state['publish_timestamp'] = min(events, key=lambda x:int(x['Event']['publish_timestamp']))['Event']['publish_timestamp']
-                    state['ts_imported_events'] = [event['Event']['id'] for event in events if int(event['Event']['publish_timestamp']) == state['publish_timestamp']]
+                if continuous_importing and len(page_events) > 0:
+                    state['publish_timestamp'] = min(page_events, key=lambda x:int(x[1]))[1]
+                    state['ts_imported_events'] = [event_id for event_id, publish_timestamp in page_events if int(publish_timestamp) == state['publish_timestamp']]
                     log.log_event(logger, state, logging.INFO)
                 
-            log.log_event(logger, event_ingestor.get_stats(), logging.INFO)
+            event_ingestor.flush()
+            log.log_event(logger, {**event_ingestor.get_stats(), **misp_client.get_stats(), 'page_sizes': page_sizer.get_stats()}, logging.INFO)
+            misp_client.close()
 
             log.events_ingested(
                 logger,
@@ -201,4 +206,7 @@ def stream_events(inputs: smi.InputDefinition, event_writer: smi.EventWriter):
             log.modular_input_end(logger, normalized_input_name)
 
         except Exception as e:
-            log.log_exception(logger, e, "TA_MISP_event_input", msg_before="Exception raised while ingesting data for misp_event_input: ")
\ No newline at end of file
+            log.log_exception(logger, e, "TA_MISP_event_input", msg_before="Exception raised while ingesting data for misp_event_input: ")
+
+    # stanzas of different MISP instances are run in parallel
+    run_stanzas(inputs.inputs, ingest_stanza, input_workers)
@@ -7,16 +7,24 @@ from splunklib import modularinput as smi
 import re
 import requests
 import math
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 from splunk_generic import get_bool_val
 import splunk_generic
-from misp_client import MISPHTTPClient
+from misp_client import MISPHTTPClient, PageSizer
 from state_store import FileStateStore
+from ioc_store import IOCStore
+import ioc_snapshot
+from bloom_filter import IOCBloomFilter
 
-from input_utils import SplunkEventIngestor
+from input_utils import SplunkEventIngestor, run_stanzas, ItemCounter, iter_tag_views, prefetch
 
 ADDON_NAME = "TA_misp"
+# number of attributes added to the IOC store per transaction
+IOC_STORE_CHUNK_SIZE = 1000
 
 def logger_for_input(input_name: str) -> logging.Logger:
     return log.Logs().get_logger(f"{ADDON_NAME.lower()}_{input_name}")
@@ -35,12 +43,7 @@ def validate_input(definition: smi.ValidationDefinition):
     if ignore_proxy:
         proxies = None
 
-    misp_client = MISPHTTPClient(
-        misp_url,
-        account['auth_key'],
-        get_bool_val(account['tls_verify']),
-        proxies
-    )
+    misp_client = MISPHTTPClient.from_account(account, proxies)
     result = misp_client.get_attributes(
             limit=1,
             page=0
@@ -50,68 +53,136 @@ def validate_input(definition: smi.ValidationDefinition):
     return
 
 
+def store_items(items, ioc_store, timestamp, raw_items=False, chunk_size=IOC_STORE_CHUNK_SIZE):
+    # adds the items to the IOC store in chunks while they are consumed, so a
+    # streamed page is never held in memory as a whole
+    chunk = []
+    for item in items:
+        if int((item[0] if raw_items else item)['timestamp']) >= timestamp:
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                ioc_store.add_attributes(chunk)
+                chunk = []
+        yield item
+    ioc_store.add_attributes(chunk)
+
+
+def iter_events(misp_client, request_event_limit, page_limit, publish_timestamp):
+    # yields the events published since publish_timestamp page by page
+    for page in range(1, page_limit + 1):
+        events = misp_client.get_events(
+            limit=request_event_limit,
+            page=page,
+            publish_timestamp=publish_timestamp
+        )['response']
+        yield from events
+        if len(events) < request_event_limit:
+            break
+
+
 def ingest_attributes(
         event_ingestor: SplunkEventIngestor, misp_client, logger, request_limit, page_limit, event_id, types, to_ids, published, 
-        include_tags, exclude_tags, enforce_warninglist, timestamp, normalize_field_names, normalized_field_prefix, expand_tags):
+        include_tags, exclude_tags, enforce_warninglist, timestamp, normalize_field_names, normalized_field_prefix, expand_tags,
+        stream_responses=False, raw_passthrough=False, start_offset=0, page_callback=None, pagination='offset', start_cursor=None,
+        page_sizer=None, ioc_store=None):
+    # the raw pass-through ingests the attributes as sent by MISP, which is only
+    # possible if they are neither normalized nor expanded
+    raw_passthrough = raw_passthrough and not normalize_field_names and not expand_tags
+    filters = {
+        'event_id': event_id,
+        'types': types,
+        'to_ids': to_ids,
+        'published': published,
+        'include_tags': include_tags,
+        'exclude_tags': exclude_tags,
+        'enforce_warninglist': enforce_warninglist,
+        'include_context': False,
+        'timestamp': timestamp,
+        'stream': stream_responses
+    }
+
+    # the page size is fixed unless an adaptive page sizer is given
+    if page_sizer is None:
+        page_sizer = PageSizer(request_limit, request_limit, request_limit)
+    page_sizer.start_at(start_offset)
+
+    # cursor pagination requests the attributes after the last seen timestamp instead of page offsets
+    pager = None
+    if pagination == 'cursor':
+        pager = misp_client.iter_attribute_pages(request_limit, cursor=start_cursor, raw_items=raw_passthrough, page_sizer=page_sizer, **filters)
+        pages = iter(pager)
+
     page = 0
     empty_page_count = 0
     attribute_count = 0
     while page_limit == None or page < page_limit:
         page += 1
-        result = misp_client.get_attributes(
-            limit=request_limit,
-            page=page,
-            event_id=event_id,
-            types=types,
-            to_ids=to_ids,
-            published=published,                    
-            include_tags=include_tags,
-            exclude_tags=exclude_tags,
-            enforce_warninglist=enforce_warninglist,
-            include_context=False,
-            timestamp=timestamp
-        )
-        attributes = result['response'].get('Attribute', [])      
-        attribute_count +=  len(attributes) 
-        log.log_event(logger, {'Action': 'attributes fetched', 'event_id': event_id, 'count': len(attributes), 'request_body': result.get('request_body')}, logging.DEBUG)
+        if pager:
+            result = next(pages, None)
+            if result is None:
+                page -= 1
+                break
+        else:
+            limit = page_sizer.limit
+            result = misp_client.get_attributes(
+                limit=limit,
+                page=page_sizer.page,
+                raw_items=raw_passthrough,
+                **filters
+            )
+        # attributes are counted while they are ingested, as they may be streamed
+        page_attributes = ItemCounter(result['response'].get('Attribute', []))
+        attributes = page_attributes
+
+        # the attributes are added to the local IOC store as sent by MISP
+        if ioc_store is not None:
+            attributes = store_items(attributes, ioc_store, timestamp, raw_items=raw_passthrough)
 
         if normalize_field_names:
-             mapping_function=lambda x:MISPHTTPClient.map_attribute(x, normalized_field_prefix)
+            mapping_function=MISPHTTPClient.get_attribute_mapper(normalized_field_prefix).map
         else:
             mapping_function=lambda x:x
 
         if expand_tags:
-            expanded_attributes = []
-            for attribute in attributes:
-                if 'Tag' not in attribute:
-                    attribute['Tag'] = []                    
-
-                if len(attribute['Tag']) >= 1:
-                    for tag in attribute['Tag']:
-                        expanded_attribute = attribute.copy()
-                        expanded_attribute['Tag'] = tag
-                        expanded_attributes.append(expanded_attribute)
-                else:
-                    expanded_attribute = attribute.copy()
-                    expanded_attribute['Tag'] = None
-                    expanded_attributes.append(expanded_attribute)
-            attributes = expanded_attributes
+            attributes = iter_tag_views(attributes)
+            if normalize_field_names:
+                # the attribute is mapped directly instead of through its view
+                mapper = MISPHTTPClient.get_attribute_mapper(normalized_field_prefix)
+                mapping_function = lambda x:mapper.map(x.item, x.tag)
 
         event_ingestor.ingest_items(
             attributes,
             mapping_function=mapping_function,
-            skip_check=lambda x:int(x['timestamp']) < timestamp
+            skip_check=lambda x:int(x['timestamp']) < timestamp,
+            raw_items=raw_passthrough
         )
+        attribute_count += page_attributes.count
+        log.log_event(logger, {'Action': 'attributes fetched', 'event_id': event_id, 'count': page_attributes.count, 'request_body': result.get('request_body')}, logging.DEBUG)
+        if not pager:
+            page_sizer.observe(page_attributes.count, result['response_stats'])
+
+        # page_callback is called with the page, its last attribute and the position
+        # of the next page (offset or cursor) once the page is ingested
+        if page_callback and page_attributes.count > 0:
+            page_callback(
+                page,
+                page_attributes.last[0] if raw_passthrough else page_attributes.last,
+                {'cursor': pager.cursor} if pager else {'offset': page_sizer.offset}
+            )
+
+        if pager:
+            # the pager ends on its own
+            continue
 
         # Abort
-        if len(attributes) == 0:
+        if page_attributes.count == 0:
             empty_page_count += 1
         if empty_page_count > 4: # safeguard when bug fixed
             break
 
         if 'X-Skipped-Elements-Count' in result['headers']:
             # if MISP support X-Skipped-Elements-Count this is the exact abort condition
-            if len(attributes) + int(result['headers']['X-Skipped-Elements-Count']) < request_limit:
+            if page_attributes.count + int(result['headers']['X-Skipped-Elements-Count']) < limit:
                 break
             x_result_count = 0
         elif 'X-Result-Count' in result['headers']:
@@ -120,11 +191,11 @@ def ingest_attributes(
             x_result_count = int(result['headers']['x-result-count'])
         else:
             x_result_count = 0
-        if (x_result_count-1)%request_limit == 0 and len(attributes) == 0:
+        if (x_result_count-1)%limit == 0 and page_attributes.count == 0:
         # hacky breakup condition might relay on a MISP bug
         # see https://github.com/MISP/MISP/issues/9175
             break
-    log.log_event(logger, {'Action': 'attributes fetched', 'event_id': event_id, 'count': attribute_count, 'pages': page, 'empty_pages': empty_page_count}, logging.INFO)
+    log.log_event(logger, {'Action': 'attributes fetched', 'event_id': event_id, 'count': attribute_count, 'pagination': pagination, 'start_offset': start_offset, 'pages': page, 'empty_pages': empty_page_count, 'limit': page_sizer.limit}, logging.INFO)
 
 
 
@@ -142,8 +213,12 @@ def stream_events(inputs: smi.InputDefinition, event_writer: smi.EventWriter):
     # }
     session_key = inputs.metadata["session_key"]
     proxies = splunk_generic.get_proxy_config(session_key)
+    input_workers = int(splunk_generic.get_global_config(session_key).get('input_workers', 4))
+
+    # the ingestors of all stanzas write to the same event writer
+    writer_lock = threading.Lock()
 
-    for input_name, input_item in inputs.inputs.items():
+    def ingest_stanza(input_name, input_item):
         normalized_input_name = input_name.split("/")[-1]
 
         state_store = FileStateStore(
@@ -164,6 +239,7 @@ def stream_events(inputs: smi.InputDefinition, event_writer: smi.EventWriter):
             
             request_attribute_limit = int(account.get('request_attribute_limit', 1000))
             request_event_limit = int(account.get('request_event_limit', 1000))
+            pagination = account.get('pagination', 'offset')
             ignore_proxy = get_bool_val(account.get('ignore_proxy', "0"))
             max_requests = int(input_item.get('max_requests', 1000))
             continuous_importing = get_bool_val(input_item.get('continuous_importing', True))
@@ -171,9 +247,16 @@ def stream_events(inputs: smi.InputDefinition, event_writer: smi.EventWriter):
             normalize_field_names = get_bool_val(input_item.get('normalize_field_names', True))
             normalized_field_prefix = input_item.get('normalized_field_prefix', "misp_")
             expand_tags = get_bool_val(input_item.get('expand_tags', False))
+            event_workers = int(input_item.get('event_workers', 1))
+            stream_responses = get_bool_val(input_item.get('stream_responses', False))
+            event_batch_size = int(input_item.get('event_batch_size', 500))
+            raw_passthrough = get_bool_val(input_item.get('raw_passthrough', False))
+            use_ioc_store = get_bool_val(input_item.get('ioc_store', False))
+            build_ioc_snapshot = use_ioc_store and get_bool_val(input_item.get('ioc_snapshot', False))
+            use_bloom_filter = use_ioc_store and get_bool_val(input_item.get('bloom_filter', False))
 
-            if ignore_proxy:
-                proxies = None
+            # each stanza uses the proxy settings of its own account
+            account_proxies = None if ignore_proxy else proxies
 
             # time conversation
             input_duration = input_item.get('import_period', '180d')
@@ -191,21 +274,28 @@ def stream_events(inputs: smi.InputDefinition, event_writer: smi.EventWriter):
                 earliest_timestamp = int(earliest_timestamp.timestamp())
 
             # initialize MISP Client
-            misp_client = MISPHTTPClient(
-                misp_url,
-                account['auth_key'],
-                get_bool_val(account['tls_verify']),
-                proxies
-            )
+            misp_client = MISPHTTPClient.from_account(account, account_proxies, logger)
 
             log.log_event(logger, {'Action': 'override', 'override_timestamps': override_timestamps, 'input_item': input_item, 'account': account}, logging.DEBUG)
 
+            # local mirror of the ingested attributes for mispsearchattributes source=local
+            ioc_store = None
+            if use_ioc_store:
+                ioc_store = IOCStore.for_account(splunk_generic.get_state_dir(), input_item['misp_instance'])
+            # per IOC group prefilter of the store, updated with the ingested attributes
+            bloom_filter = None
+            if use_bloom_filter:
+                bloom_filter = IOCBloomFilter.for_account(splunk_generic.get_state_dir(), input_item['misp_instance'])
+                bloom_filter.open(ioc_store)
+
             event_ingestor = SplunkEventIngestor(
                 event_writer,
                 input_item.get('index'),
                 "{}_{}".format(input_name, misp_url.split('/')[-1]),
                 input_item.get('sourcetype'),
-                override_timestamps            
+                override_timestamps,
+                batch_size=event_batch_size,
+                lock=writer_lock
             )
 
             # continuous importing
@@ -215,38 +305,72 @@ def stream_events(inputs: smi.InputDefinition, event_writer: smi.EventWriter):
                 if not state:
                     state = {
                         'publish_timestamp': earliest_timestamp,
-                        'ts_imported_events': []
+                        'ts_imported_events': [],
+                        'event_cursors': {}
                     }
                     if continuous_importing: state_store.update_state(state)
+                # page cursors of events which are not completely ingested, by event id
+                state.setdefault('event_cursors', {})
+                state_lock = threading.Lock()
                 log.log_event(logger, state, logging.INFO)
 
-                # pull events in 1000 event batches
-                events = []
-                for i in range(0, math.ceil(max_requests/request_event_limit)):
-                    page = i+1
-                    event_batch = misp_client.get_events(
-                        limit=request_event_limit,
-                        page=page,
-                        publish_timestamp=state['publish_timestamp']
-                    )
-                    events.extend(event_batch['response'])
-                    if len(event_batch) < request_event_limit:
-                        break
-
-                for event in events:
-                    event = event['Event']
-                    if event['id'] in state['ts_imported_events'] and int(event['publish_timestamp']) == state['publish_timestamp']:
-                        # ignore already imported events when timestamp has not changed
-                        log_event = {
-                            'info': "Event already imported",
-                            'event_id': event['id'],
-                            'publish_timestamp': event['publish_timestamp']
-                        }
-                        log.log_event(logger, log_event, logging.INFO)
-                        continue
-
+                # the events are requested from the publish timestamp of the last run, the state
+                # is updated while events are committed, so the filter and skip check use a snapshot
+                publish_timestamp = state['publish_timestamp']
+                imported_event_ids = set(state['ts_imported_events'])
+
+                def iter_events_to_import():
+                    for event in iter_events(misp_client, request_event_limit, math.ceil(max_requests/request_event_limit), publish_timestamp):
+                        event = event['Event']
+                        if event['id'] in imported_event_ids and int(event['publish_timestamp']) == publish_timestamp:
+                            # ignore already imported events when timestamp has not changed
+                            log_event = {
+                                'info': "Event already imported",
+                                'event_id': event['id'],
+                                'publish_timestamp': event['publish_timestamp']
+                            }
+                            log.log_event(logger, log_event, logging.INFO)
+                            continue
+                        yield event
+
+                page_size_hint = {'limit': request_attribute_limit}
+
+                def fetch_event_attributes(event):
                     log.log_event(logger, {'Action': 'fetch attributes started', 'event_id': event['id'], 'publish_timestamp': event['publish_timestamp']}, logging.DEBUG)
 
+                    # resume after the last ingested page if the previous run stopped within
+                    # this event, page offsets are only valid as long as it is not republished
+                    # and the attributes are filtered with the same earliest timestamp, which
+                    # moves with each run, so the timestamp of the interrupted run is reused
+                    start_offset = 0
+                    start_cursor = None
+                    event_earliest_timestamp = earliest_timestamp
+                    with state_lock:
+                        cursor = state['event_cursors'].get(event['id'])
+                    if cursor and cursor['publish_timestamp'] == event['publish_timestamp'] and ('cursor' in cursor) == (pagination == 'cursor') and 'earliest_timestamp' in cursor:
+                        start_offset = cursor.get('offset', 0)
+                        start_cursor = cursor.get('cursor')
+                        event_earliest_timestamp = cursor['earliest_timestamp']
+                        log.log_event(logger, {'Action': 'resume event', 'event_id': event['id'], **cursor}, logging.INFO)
+
+                    # the page size learned from previous events is the start value
+                    page_sizer = PageSizer.from_account(account, page_size_hint['limit'], pagination != 'cursor', logger, 'attributes')
+
+                    def save_cursor(page, last_attribute, position):
+                        # buffered events must be written before the checkpoint
+                        event_ingestor.flush()
+                        event_cursor = {
+                            'publish_timestamp': event['publish_timestamp'],
+                            'earliest_timestamp': event_earliest_timestamp,
+                            'page': page,
+                            'timestamp': last_attribute['timestamp'],
+                            'id': last_attribute['id'],
+                            **position
+                        }
+                        with state_lock:
+                            state['event_cursors'][event['id']] = event_cursor
+                            state_store.update_state(state)
+
                     ingest_attributes(
                         event_ingestor,
                         misp_client,
@@ -260,11 +384,27 @@ def stream_events(inputs: smi.InputDefinition, event_writer: smi.EventWriter):
                         input_item.get('include_tags', None),
                         input_item.get('exclude_tags', None),
                         get_bool_val(input_item.get('warning_list', True)),
-                        earliest_timestamp,
+                        event_earliest_timestamp,
                         normalize_field_names,
                         normalized_field_prefix,
-                        expand_tags
+                        expand_tags,
+                        stream_responses,
+                        raw_passthrough,
+                        start_offset=start_offset,
+                        page_callback=save_cursor,
+                        pagination=pagination,
+                        start_cursor=start_cursor,
+                        page_sizer=page_sizer,
+                        ioc_store=ioc_store
                     )
+                    page_size_hint['limit'] = page_sizer.limit
+
+                def commit_event(event, future):
+                    # wait until all attributes of this event are ingested
+                    future.result()
+
+                    # buffered events must be written before the checkpoint
+                    event_ingestor.flush()
 
                     # Update state
                     event_publish_timestamp = int(event['publish_timestamp'])
@@ -275,14 +415,39 @@ def stream_events(inputs: smi.InputDefinition, event_writer: smi.EventWriter):
                         }
                         log.log_event(logger, log_event, logging.ERROR)
 
-                    if state['publish_timestamp'] < event_publish_timestamp:
-                        state['publish_timestamp'] = event_publish_timestamp
-                        state['ts_imported_events'] = [event['id']]
-                    else:
-                        # Store ingested events with this timestamp to avoid double ingesting
-                        state['ts_imported_events'].append(event['id'])                
-                    state_store.update_state(state)
-                    log.log_event(logger, state, logging.INFO)
+                    with state_lock:
+                        if state['publish_timestamp'] < event_publish_timestamp:
+                            state['publish_timestamp'] = event_publish_timestamp
+                            state['ts_imported_events'] = [event['id']]
+                        else:
+                            # Store ingested events with this timestamp to avoid double ingesting
+                            state['ts_imported_events'].append(event['id'])
+                        state['event_cursors'].pop(event['id'], None)
+                        state_store.update_state(state)
+                        log.log_event(logger, state, logging.INFO)
+
+                # events are streamed from their pages, the next page is fetched by a separate thread
+                # while the attributes of the last events of the current one are ingested, so at most
+                # two event pages are held in memory and ingesting starts with the first event
+                # attributes of up to event_workers events are fetched in parallel,
+                # the state is committed strictly in publish order, so after a crash
+                # the next run restarts at the oldest event which is not fully ingested
+                events_to_import = prefetch(iter_events_to_import())
+                with ThreadPoolExecutor(max_workers=event_workers) as executor:
+                    pending = deque()
+                    try:
+                        for event in events_to_import:
+                            pending.append((event, executor.submit(fetch_event_attributes, event)))
+                            if len(pending) >= event_workers:
+                                commit_event(*pending.popleft())
+                        while pending:
+                            commit_event(*pending.popleft())
+                    except Exception:
+                        for _, future in pending:
+                            future.cancel()
+                        raise
+                    finally:
+                        events_to_import.close()
 
             else:
                 ingest_attributes(
@@ -301,10 +466,29 @@ def stream_events(inputs: smi.InputDefinition, event_writer: smi.EventWriter):
                         earliest_timestamp,
                         normalize_field_names,
                         normalized_field_prefix,
-                        expand_tags
+                        expand_tags,
+                        stream_responses,
+                        raw_passthrough,
+                        pagination=pagination,
+                        page_sizer=PageSizer.from_account(account, request_attribute_limit, pagination != 'cursor', logger, 'attributes'),
+                        ioc_store=ioc_store
                     )
                 
-            log.log_event(logger, event_ingestor.get_stats(), logging.INFO)
+            event_ingestor.flush()
+            ioc_store_stats = {}
+            if ioc_store is not None:
+                # attributes older than the import periods of all stanzas of the instance are removed from the store
+                ioc_store_stats['ioc_store_pruned'] = ioc_store.prune(normalized_input_name, earliest_timestamp)
+                ioc_store_stats.update(ioc_store.get_stats())
+                if bloom_filter is not None:
+                    bloom_filter.close(ioc_store)
+                    ioc_store_stats['bloom_filter'] = bloom_filter.get_stats()
+                if build_ioc_snapshot:
+                    # the snapshot for mispmatch is only rewritten if the store changed
+                    ioc_store_stats['ioc_snapshot'] = ioc_snapshot.build_from_store(ioc_store, ioc_snapshot.snapshot_path(input_item['misp_instance']))
+                ioc_store.close()
+            log.log_event(logger, {**event_ingestor.get_stats(), **misp_client.get_stats(), **ioc_store_stats}, logging.INFO)
+            misp_client.close()
 
             log.events_ingested(
                 logger,
@@ -317,4 +501,7 @@ def stream_events(inputs: smi.InputDefinition, event_writer: smi.EventWriter):
             log.modular_input_end(logger, normalized_input_name)
 
         except Exception as e:
-            log.log_exception(logger, e, "TA_MISP_indicator_input", msg_before="Exception raised while ingesting data for misp_indicator_input: ")
\ No newline at end of file
+            log.log_exception(logger, e, "TA_MISP_indicator_input", msg_before="Exception raised while ingesting data for misp_indicator_input: ")
+
+    # stanzas of different MISP instances are run in parallel
+    run_stanzas(inputs.inputs, ingest_stanza, input_workers)
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # file locks are not available (Windows), requests are not limited
+    fcntl = None
+
+POLL_INTERVAL = 0.05
+
+
+class RequestLimiter:
+    """
+    Limits the requests to a MISP instance across all processes of the app (inputs and
+    search commands) on this host. The state is kept in files below state_dir:
+
+    - concurrency: each running request holds an exclusive lock on one of concurrency slot
+      files, locks are released by the OS if a process dies
+    - rate: a token bucket refilled with rate tokens per second, kept in a JSON file which
+      is read and written while holding an exclusive lock
+
+    Interactive requests (search commands) are prioritized over background requests (inputs):
+    one slot and a share of the tokens are reserved for them.
+    """
+    INTERACTIVE_SHARE = 0.25
+
+    def __init__(self, state_dir, name, concurrency=0, rate=0.0, interactive=False):
+        self.concurrency = concurrency if fcntl else 0
+        self.rate = rate if fcntl else 0.0
+        self.interactive = interactive
+        self.wait_seconds = 0.0
+
+        key = hashlib.sha256(name.encode('utf-8')).hexdigest()[:16]
+        self.path = os.path.join(state_dir, f'request_limiter_{key}')
+        if self.concurrency or self.rate:
+            os.makedirs(state_dir, exist_ok=True)
+
+        # background requests leave the last slot and a share of the tokens to interactive ones
+        self.slots = self.concurrency
+        if not interactive and self.concurrency > 1:
+            self.slots = self.concurrency - 1
+        self.reserved_tokens = max(1.0, self.rate * self.INTERACTIVE_SHARE) if self.rate else 0.0
+        self.capacity = max(1.0, self.rate) + self.reserved_tokens
+
+    @classmethod
+    def from_account(cls, state_dir, account, interactive=False):
+        return cls(
+            state_dir,
+            account.get('misp_url', ''),
+            concurrency=int(account.get('rate_limit_concurrency', 0)),
+            rate=float(account.get('rate_limit_requests', 0)),
+            interactive=interactive
+        )
+
+    @property
+    def enabled(self):
+        return bool(self.concurrency or self.rate)
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent, returns the slot which has to be passed to release
+        """
+        started = time.monotonic()
+        slot = self._acquire_slot() if self.concurrency else None
+        if self.rate:
+            try:
+                self._acquire_token()
+            except BaseException:
+                self.release(slot)
+                raise
+        self.wait_seconds += time.monotonic() - started
+        return slot
+
+    def release(self, slot):
+        if slot is not None:
+            fcntl.flock(slot, fcntl.LOCK_UN)
+            os.close(slot)
+
+    def _acquire_slot(self):
+        # interactive requests try the reserved slot first to leave the others to background requests
+        indexes = list(range(self.slots))
+        if self.interactive:
+            indexes.reverse()
+        while True:
+            for index in indexes:
+                fd = os.open(f'{self.path}.slot{index}', os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except OSError:
+                    os.close(fd)
+            time.sleep(POLL_INTERVAL)
+
+    def _acquire_token(self):
+        # background requests may only take a token if the reserved tokens remain
+        required = 1.0 if self.interactive else 1.0 + self.reserved_tokens
+        while True:
+            fd = os.open(f'{self.path}.bucket', os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                with os.fdopen(os.dup(fd), 'r+') as bucket_file:
+                    content = bucket_file.read()
+                    bucket = json.loads(content) if content else {}
+                    now = time.time()
+                    tokens = bucket.get('tokens', self.capacity)
+                    elapsed = max(now - bucket.get('updated', now), 0.0)
+                    tokens = min(self.capacity, tokens + elapsed * self.rate)
+                    if tokens >= required:
+                        tokens -= 1.0
+                        wait = 0.0
+                    else:
+                        wait = (required - tokens) / self.rate
+                    bucket_file.seek(0)
+                    bucket_file.truncate()
+                    json.dump({'tokens': tokens, 'updated': now}, bucket_file)
+            finally:
+                os.close(fd)
+
+            if not wait:
+                return
+            time.sleep(max(wait, POLL_INTERVAL))
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import time
+
+
+class ResponseCache:
+    """
+    Disk cache of MISP responses shared by all search command processes.
+
+    Each response is stored in one file named by the hash of the account and the
+    request, holding a JSON line with the metadata (creation time, headers, response
+    stats) followed by the unmodified response body. Entries older than ttl seconds are
+    not returned, the file mtime is updated on each hit and if the cache grows beyond
+    max_bytes the least recently used entries are removed.
+    """
+    SUFFIX = '.response'
+
+    def __init__(self, cache_dir, ttl=300, max_bytes=100 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hit_count = 0
+        self.miss_count = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(misp_url, auth_key, method, endpoint, data=None):
+        # the request body is normalized, so the order of its keys does not matter
+        if data:
+            try:
+                data = json.dumps(json.loads(data), sort_keys=True, separators=(',', ':'))
+            except ValueError:
+                pass
+        key = json.dumps([misp_url, auth_key, method, endpoint, data or ''])
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + self.SUFFIX)
+
+    def get(self, key):
+        """
+        Returns (headers, body, response_stats) of a cached response or None
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as cache_file:
+                meta = json.loads(cache_file.readline())
+                if time.time() - meta['created'] > self.ttl:
+                    self.miss_count += 1
+                    return None
+                body = cache_file.read()
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            self.miss_count += 1
+            return None
+        self.hit_count += 1
+        return meta['headers'], body, meta['response_stats']
+
+    def put(self, key, headers, body, response_stats):
+        meta = json.dumps({'created': time.time(), 'headers': headers, 'response_stats': response_stats})
+        path = self._path(key)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as cache_file:
+            cache_file.write(meta.encode('utf-8') + b'\n')
+            cache_file.write(body)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        # the ttl is chosen per search, so entries are only removed by size, least recently used first
+        entries = []
+        total_bytes = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(self.SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            total_bytes += stat.st_size
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        if total_bytes <= self.max_bytes:
+            return
+        entries.sort()
+        for mtime, size, path in entries:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_bytes -= size
+            if total_bytes <= self.max_bytes:
+                break
+
+    def get_stats(self):
+        return {'cache_hits': self.hit_count, 'cache_misses': self.miss_count}
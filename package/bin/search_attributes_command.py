@@ -13,10 +13,17 @@ from splunklib.searchcommands import \
 
 import splunk_generic
 from splunk_generic import get_bool_val
-from misp_client import MISPHTTPClient
+from misp_client import MISPHTTPClient, PageSizer
+from response_cache import ResponseCache
+from ioc_store import IOCStore
+from bloom_filter import IOCBloomFilter
 from datetime import datetime
 import re
 import math
+from itertools import islice
+
+# attributes of the local IOC store which are built into records at once
+LOCAL_PAGE_SIZE = 1000
 
 @Configuration(distributed=False)
 class SearchMISPAttributesCommand(GeneratingCommand):
@@ -190,6 +197,40 @@ class SearchMISPAttributesCommand(GeneratingCommand):
         require=False
     )
 
+    source = Option(
+        doc='''
+        **Syntax:** **source=(remote|local)*
+        **Description:** remote queries MISP, local queries the local IOC store maintained by the indicator inputs of the instance.
+        The local store holds the attributes as ingested (without context), publish_date, published, warning_list and include_context do not apply.
+        **Default:** remote
+        ''',
+        require=False,
+        default='remote',
+        validate=validators.Set('remote', 'local')
+    )
+
+    cache = Option(
+        doc='''
+        **Syntax:** *cache=<1|y|Y|t|true|True|0|n|N|f|false|False>*
+        **Description:** Reuse MISP responses of identical requests of previous searches which are not older than cache_ttl.
+        **Default:** False
+        ''',
+        require=False,
+        default=False,
+        validate=validators.Boolean()
+    )
+
+    cache_ttl = Option(
+        doc='''
+        **Syntax:** **cache_ttl=<int>*
+        **Description:** Max age of cached MISP responses in seconds
+        **Default:** 300
+        ''',
+        require=False,
+        default=300,
+        validate=validators.Integer(minimum=0)
+    )
+
     def generate(self):
         session_key = self._metadata.searchinfo.session_key
         general_settings = splunk_generic.get_global_config(session_key)
@@ -205,14 +246,16 @@ class SearchMISPAttributesCommand(GeneratingCommand):
 
         account = splunk_generic.get_account(session_key, self.misp_instance)
         request_attribute_limit = int(account.get('request_attribute_limit', 1000))
+        pagination = account.get('pagination', 'offset')
         
         # MISP Client
-        misp_client = MISPHTTPClient(
-            account['misp_url'],
-            account['auth_key'],
-            get_bool_val(account['tls_verify']),
-            proxies
-        )
+        misp_client = MISPHTTPClient.from_account(account, proxies, self.logger, interactive=True)
+        if self.cache:
+            misp_client.cache = ResponseCache(
+                os.path.join(splunk_generic.get_state_dir(), 'response_cache'),
+                self.cache_ttl,
+                int(general_settings.get('cache_max_mb', 100)) * 1024 * 1024
+            )
 
     	# convert start_date to timestamp
         if self.start_date:
@@ -235,54 +278,102 @@ class SearchMISPAttributesCommand(GeneratingCommand):
 
 
 
+        attribute_mapper = MISPHTTPClient.get_attribute_mapper(self.normalize_fields_prefix)
+        record_builder = splunk_generic.RecordBuilder(self)
+        mapper = attribute_mapper.map if self.normalize_fields else None
+
+        if self.source == 'local':
+            with IOCStore.for_account(splunk_generic.get_state_dir(), self.misp_instance, readonly=True) as ioc_store:
+                # exact values which are certainly not in the store are not looked up
+                if self.value and '%' not in self.value:
+                    bloom_filter = IOCBloomFilter.for_account(splunk_generic.get_state_dir(), self.misp_instance)
+                    if bloom_filter.load_current(ioc_store) and not bloom_filter.might_contain(self.value):
+                        return
+                attributes = ioc_store.search(
+                    value=self.value,
+                    types=self.types,
+                    event_id=self.event_id,
+                    to_ids=self.to_ids,
+                    timestamp=self.start_date,
+                    include_tags=self.include_tags,
+                    exclude_tags=self.exclude_tags,
+                    limit=self.limit,
+                    order=self.order or 'timestamp ASC'
+                )
+                while True:
+                    page = list(islice(attributes, LOCAL_PAGE_SIZE))
+                    if not page:
+                        break
+                    yield from record_builder.build_page(page, mapper)
+            return
+
+        # cursor pagination orders by timestamp, so it is not used if another order is requested
+        use_cursor = pagination == 'cursor' and not self.order
+        page_sizer = PageSizer.from_account(account, request_attribute_limit, not use_cursor, self.logger, 'attributes')
+        pager = None
+        if use_cursor:
+            pager = iter(misp_client.iter_attribute_pages(
+                request_attribute_limit,
+                page_sizer=page_sizer,
+                event_id=self.event_id,
+                published=self.published,
+                timestamp=self.start_date,
+                to_ids=self.to_ids,
+                enforce_warninglist=self.warning_list,
+                include_context=self.include_context,
+                types=self.types,
+                include_tags=self.include_tags,
+                exclude_tags=self.exclude_tags,
+                value=self.value,
+                last=last
+            ))
+
         page_count = 0
         attribute_count = 0
         while attribute_count < self.limit:
             page_count += 1
             try:
-                result = misp_client.get_attributes(
-                    request_attribute_limit,
-                    page_count,                    
-                    self.event_id,
-                    self.published,
-                    self.start_date,
-                    self.to_ids,
-                    self.warning_list,
-                    self.include_context,
-                    self.types,                  
-                    self.include_tags,
-                    self.exclude_tags,                    
-                    value=self.value,
-                    order=self.order,
-                    last=last
-                )
+                if pager:
+                    result = next(pager, None)
+                    if result is None:
+                        break
+                else:
+                    result = misp_client.get_attributes(
+                        page_sizer.limit,
+                        page_sizer.page,                    
+                        self.event_id,
+                        self.published,
+                        self.start_date,
+                        self.to_ids,
+                        self.warning_list,
+                        self.include_context,
+                        self.types,                  
+                        self.include_tags,
+                        self.exclude_tags,                    
+                        value=self.value,
+                        order=self.order,
+                        last=last
+                    )
             except Exception as e:
                 yield {'_raw': str(e)}
                 return
 
             attributes = result['response'].get('Attribute', [])
             attribute_count += len(attributes)
-            for attribute in attributes:
-                splunk_ts = attribute['timestamp']
-                if self.normalize_fields:
-                    attribute = MISPHTTPClient.map_attribute(attribute, self.normalize_fields_prefix)
-
-                yield splunk_generic.generate_record(
-                    attribute,
-                    splunk_ts,
-                    self
-                )
+            yield from record_builder.build_page(attributes, mapper)
+            if not pager:
+                page_sizer.observe(len(attributes), result['response_stats'])
             if 'X-Result-Count' in result['headers']:
                 x_result_count = int(result['headers']['X-Result-Count'])
             elif 'x-result-count' in result['headers']:
                 x_result_count = int(result['headers']['x-result-count'])
             else:
                 x_result_count = 0
-            if (x_result_count-1)%self.limit == 0 and len(attributes) == 0:
+            if not pager and (x_result_count-1)%self.limit == 0 and len(attributes) == 0:
                 # hacky breakup condition might relay on a MISP bug
                 break
 
-        self.logger.debug(f"MISP fetched {attribute_count} attributes in {page_count} pages")
+        self.logger.debug(f"MISP fetched {attribute_count} attributes in {page_count} pages, page sizes: {page_sizer.get_stats()}, client: {misp_client.get_stats()}")
 
 
 dispatch(SearchMISPAttributesCommand, sys.argv, sys.stdin, sys.stdout, __name__)
\ No newline at end of file
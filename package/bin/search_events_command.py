@@ -18,6 +18,7 @@ from splunklib.searchcommands import \
 import splunk_generic
 from splunk_generic import get_bool_val
 from misp_client import MISPHTTPClient
+from response_cache import ResponseCache
 
 @Configuration()
 class SearchMISPEventsCommand(GeneratingCommand):
@@ -138,6 +139,28 @@ class SearchMISPEventsCommand(GeneratingCommand):
         require=False
     )
 
+    cache = Option(
+        doc='''
+        **Syntax:** *cache=<1|y|Y|t|true|True|0|n|N|f|false|False>*
+        **Description:** Reuse MISP responses of identical requests of previous searches which are not older than cache_ttl.
+        **Default:** False
+        ''',
+        require=False,
+        default=False,
+        validate=validators.Boolean()
+    )
+
+    cache_ttl = Option(
+        doc='''
+        **Syntax:** **cache_ttl=<int>*
+        **Description:** Max age of cached MISP responses in seconds
+        **Default:** 300
+        ''',
+        require=False,
+        default=300,
+        validate=validators.Integer(minimum=0)
+    )
+
     include_context = Option(
         doc='''
         **Syntax:** *include_context=<1|y|Y|t|true|True|0|n|N|f|false|False>*
@@ -185,12 +208,13 @@ class SearchMISPEventsCommand(GeneratingCommand):
         request_event_limit = int(account.get('request_event_limit', 1000))
 
         # MISP Client
-        misp_client = MISPHTTPClient(
-            account['misp_url'],
-            account['auth_key'],
-            get_bool_val(account['tls_verify']),
-            proxies
-        )
+        misp_client = MISPHTTPClient.from_account(account, proxies, self.logger, interactive=True)
+        if self.cache:
+            misp_client.cache = ResponseCache(
+                os.path.join(splunk_generic.get_state_dir(), 'response_cache'),
+                self.cache_ttl,
+                int(general_settings.get('cache_max_mb', 100)) * 1024 * 1024
+            )
 
 
 
@@ -211,6 +235,10 @@ class SearchMISPEventsCommand(GeneratingCommand):
             else:
                 self.publish_date = int(datetime.strptime(self.publish_date, '%Y-%m-%d').timestamp())
 
+        event_mapper = MISPHTTPClient.get_event_mapper(self.normalize_fields_prefix)
+        record_builder = splunk_generic.RecordBuilder(self)
+        mapper = event_mapper.map if self.normalize_fields else None
+
         page_count = 0
         event_count = 0
         while event_count < self.limit:
@@ -235,17 +263,7 @@ class SearchMISPEventsCommand(GeneratingCommand):
             events = result['response']
             event_count += len(events)
 
-            for event in events:
-                event = event['Event']
-                splunk_ts = event['timestamp']
-                if self.normalize_fields:
-                    event = MISPHTTPClient.map_event(event, self.normalize_fields_prefix)
-                
-                yield splunk_generic.generate_record(
-                    event,
-                    splunk_ts,
-                    self
-                )
+            yield from record_builder.build_page((event['Event'] for event in events), mapper)
             if 'X-Result-Count' in result['headers']:
                 x_result_count = int(result['headers']['X-Result-Count'])
             elif 'x-result-count' in result['headers']:
@@ -256,6 +274,7 @@ class SearchMISPEventsCommand(GeneratingCommand):
                 # hacky breakup condition might relay on a MISP bug
                 break
 
+        self.logger.debug(f"MISP fetched {event_count} events in {page_count} pages, client: {misp_client.get_stats()}")
 
 
 dispatch(SearchMISPEventsCommand, sys.argv, sys.stdin, sys.stdout, __name__)
\ No newline at end of file
@@ -1,6 +1,9 @@
 from solnlib import conf_manager, log
+import os
 import time
 import json
+import tempfile
+import threading
 
 from collections import OrderedDict
 from itertools import chain
@@ -15,45 +18,80 @@ def get_bool_val(value):
     if isinstance(value, str):
         return value != "0" and value != "false"
 
+# the account and settings conf files are fetched at once and kept per process for
+# CONFIG_TTL seconds, so stanzas and search commands do not query splunkd each time
+CONFIG_TTL = 300
+ACCOUNT_REALM = f"__REST_CREDENTIAL__#{ADDON_NAME}#configs/conf-{ADDON_NAME.lower()}_account"
+SETTINGS_REALM = f"__REST_CREDENTIAL__#{ADDON_NAME}#configs/conf-local/{ADDON_NAME.lower()}_settings"
+
+_config_cache = {}
+_config_lock = threading.Lock()
+
+
+def get_conf_stanzas(session_key: str, conf_name: str, realm: str):
+    """
+    Returns all stanzas of a conf file of the app with decrypted credentials by stanza name,
+    cached per session key for CONFIG_TTL seconds
+    """
+    cache_key = (session_key, conf_name)
+    # concurrent callers wait for the first fetch instead of fetching as well
+    with _config_lock:
+        cached = _config_cache.get(cache_key)
+        if cached is not None and time.monotonic() - cached[0] < CONFIG_TTL:
+            return cached[1]
+        cfm = conf_manager.ConfManager(session_key, ADDON_NAME, realm=realm)
+        stanzas = cfm.get_conf(conf_name).get_all()
+        _config_cache[cache_key] = (time.monotonic(), stanzas)
+        return stanzas
+
+
+def get_accounts(session_key: str):
+    return {name: dict(account) for name, account in get_conf_stanzas(session_key, f"{ADDON_NAME.lower()}_account", ACCOUNT_REALM).items()}
+
+
 def get_account(session_key: str, account_name: str):
-    cfm = conf_manager.ConfManager(
-        session_key,
-        ADDON_NAME,
-        realm=f"__REST_CREDENTIAL__#{ADDON_NAME}#configs/conf-{ADDON_NAME.lower()}_account",
-    )
-    account_conf_file = cfm.get_conf(f"{ADDON_NAME.lower()}_account")
-    return account_conf_file.get(account_name)
+    account = get_conf_stanzas(session_key, f"{ADDON_NAME.lower()}_account", ACCOUNT_REALM).get(account_name)
+    if account is None:
+        raise Exception(f"Account {account_name} not found")
+    return dict(account)
+
+
+def get_settings(session_key: str, stanza_name: str):
+    settings = get_conf_stanzas(session_key, f"{ADDON_NAME.lower()}_settings", SETTINGS_REALM).get(stanza_name)
+    if settings is None:
+        raise Exception(f"Settings {stanza_name} not found")
+    return dict(settings)
+
+
+def get_state_dir():
+    """
+    Directory for state shared by all inputs and search commands of the app, next to the
+    checkpoint directories of the inputs
+    """
+    splunk_home = os.environ.get('SPLUNK_HOME')
+    if splunk_home:
+        return os.path.join(splunk_home, 'var', 'lib', 'splunk', 'modinputs', ADDON_NAME.lower())
+    return os.path.join(tempfile.gettempdir(), ADDON_NAME.lower())
 
 
 def get_log_level(session_key: str, logger):
-    return conf_manager.get_log_level(
-        logger=logger,
-        session_key=session_key,
-        app_name=ADDON_NAME,
-        conf_name=f'{ADDON_NAME.lower()}_settings'
-    )
+    # like conf_manager.get_log_level, but from the cached settings
+    try:
+        settings = get_conf_stanzas(session_key, f"{ADDON_NAME.lower()}_settings", SETTINGS_REALM)
+    except conf_manager.ConfManagerException:
+        logger.error(f"Failed to fetch configuration file {ADDON_NAME.lower()}_settings, taking INFO as log level.")
+        return 'INFO'
+    return settings.get('logging', {}).get('loglevel', 'INFO')
 
 def set_log_level(session_key: str, logger):
     log_level = get_log_level(session_key, logger)
     logger.setLevel(log_level)
 
 def get_global_config(session_key):
-    cfm = conf_manager.ConfManager(
-        session_key,
-        ADDON_NAME,
-        realm=f"__REST_CREDENTIAL__#{ADDON_NAME}#configs/conf-local/{ADDON_NAME.lower()}_settings"    
-    )
-    settings_conf_file = cfm.get_conf(f"{ADDON_NAME.lower()}_settings")
-    return settings_conf_file.get('global_settings')
+    return get_settings(session_key, 'global_settings')
 
 def get_proxy_config(session_key):
-    cfm = conf_manager.ConfManager(
-        session_key,
-        ADDON_NAME,
-        realm=f"__REST_CREDENTIAL__#{ADDON_NAME}#configs/conf-local/{ADDON_NAME.lower()}_settings"        
-    )
-    settings_conf_file = cfm.get_conf(f"{ADDON_NAME.lower()}_settings")
-    proxy_settings = settings_conf_file.get('proxy')
+    proxy_settings = get_settings(session_key, 'proxy')
 
     if get_bool_val(proxy_settings.get('proxy_enabled', False)):
         
@@ -95,25 +133,77 @@ def normalize_data(key, value):
             normalized_data.extend(normalize_data(k,v))
     return normalized_data    
 
-def generate_record(data, time=time.time(), generator=None):
-    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
-
-    data_dict = dict()
-    data_dict['_time'] = time
-    data_dict['_raw'] = encoder.encode(data)
-    record = normalize_data('none', data)
-    for key,val in record:
-        val = str(val)
-        key = str(key)
-        if key in data_dict:
-            if isinstance(data_dict[key], list):
-                data_dict[key].append(val)
-            else:
-                data_dict[key] = [data_dict[key], val]
+class RecordBuilder:
+    """
+    Builds the search command records of MISP items: _time, _raw (the item as JSON) and a
+    field per leaf value, named by its key, values of a repeated key are multivalue fields.
+    Created once per command, the fields of a page of records are added to the custom fields
+    of the record writer at once, as the fields of a chunk are set when it is written.
+    """
+    def __init__(self, command=None):
+        self.command = command
+        self.encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+    def _flatten(self, record, key, value):
+        # one traversal of the item, string leaves (the common case) are added inline
+        value_type = type(value)
+        if value_type is dict:
+            for item_key, item_value in value.items():
+                if type(item_value) is str:
+                    existing = record.get(item_key)
+                    if existing is None:
+                        record[item_key] = item_value
+                    elif type(existing) is list:
+                        existing.append(item_value)
+                    else:
+                        record[item_key] = [existing, item_value]
+                elif item_value is not None:
+                    self._flatten(record, item_key, item_value)
+            return
+        if value_type is list:
+            for item in value:
+                self._flatten(record, key, item)
+            return
+        if value_type is not str:
+            if not isinstance(value, (int, float)):
+                return
+            value = str(value)
+        existing = record.get(key)
+        if existing is None:
+            record[key] = value
+        elif type(existing) is list:
+            existing.append(value)
         else:
-            data_dict[key] = val
+            record[key] = [existing, value]
 
-    if generator:
-        return generator.gen_record(**data_dict)
-    return data_dict
+    def build(self, data, timestamp=None):
+        record = {
+            '_time': timestamp if timestamp is not None else time.time(),
+            '_raw': self.encoder.encode(data)
+        }
+        self._flatten(record, 'none', data)
+        return record
+
+    def build_page(self, items, mapper=None, time_key='timestamp'):
+        """
+        Returns the records of a page of MISP items, the time of each record is the time_key of the
+        item, mapper maps the items before they are built (e.g. FieldMapper.map)
+        """
+        build = self.build
+        if mapper is None:
+            records = [build(item, item[time_key]) for item in items]
+        else:
+            records = [build(mapper(item), item[time_key]) for item in items]
+        if self.command is not None and records:
+            fields = set()
+            for record in records:
+                fields.update(record)
+            self.command._record_writer.custom_fields |= fields
+        return records
 
+
+def generate_record(data, time=None, generator=None):
+    record = RecordBuilder().build(data, time)
+    if generator:
+        return generator.gen_record(**record)
+    return record
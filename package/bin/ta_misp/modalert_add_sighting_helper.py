@@ -26,13 +26,7 @@ def process_event(helper, *args, **kwargs):
     
     account = splunk_generic.get_account(session_key, misp_instance)
     # MISP Client
-    misp_client = MISPHTTPClient(
-        account.get('misp_url', None),
-        account.get('auth_key'),
-        get_bool_val(account.get('tls_verify')),
-        proxies
-    )
-
-    misp_client.add_sighting(ioc, int(sighting_type))
+    with MISPHTTPClient.from_account(account, proxies) as misp_client:
+        misp_client.add_sighting(ioc, int(sighting_type))
 
     return 0
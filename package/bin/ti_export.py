@@ -0,0 +1,338 @@
+import json
+import os
+import sqlite3
+import time
+from itertools import groupby
+
+from decay_scores import DecayScorer, DECAY_SCORES_PATH
+
+# lookups of the Splunk Threat Intelligence framework, see the MISP_TI_* reports
+SECONDS_PER_DAY = 60 * 60 * 24
+
+REPORTS = {
+    'domain': {'lookup': 'MISP_TI_Domain_IOCs.csv', 'field': 'misp_domain', 'column': 'domain', 'period_days': 62},
+    'url': {'lookup': 'MISP_TI_URL_IOCs.csv', 'field': 'misp_url', 'column': 'url', 'period_days': 62},
+    'email': {'lookup': 'MISP_TI_Email_IOCs.csv', 'field': 'misp_email', 'column': 'src_user', 'period_days': 62},
+    'hash': {'lookup': 'MISP_TI_HASH_IOCs.csv', 'field': 'misp_hash', 'column': 'file_hash', 'period_days': 182},
+    'ip': {'lookup': 'MISP_TI_IP_IOCs.csv', 'field': 'misp_ip', 'column': 'ip', 'period_days': 62},
+}
+
+# fields of the mapped attributes which are aggregated
+RECORD_FIELDS = (
+    'misp_attribute_id', 'misp_timestamp', 'misp_to_ids', 'misp_deleted', 'misp_category', 'misp_event_id',
+    'misp_orgc_id', 'misp_tag', 'misp_type', 'misp_event_info'
+) + tuple(definition['field'] for definition in REPORTS.values())
+
+# fields of the returned lookup rows, the rows of all reports have the columns of all
+# lookups, as the fields of a chunk of search results are set by its first result
+LOOKUP_FIELDS = ('report', 'description') + tuple(definition['column'] for definition in REPORTS.values()) + ('weight',)
+
+# positions in the stored attribute lists
+TIMESTAMP, CATEGORY, EVENT_ID, ORG_ID, TAGS, TYPE, EVENT_INFO = range(7)
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+def get_cim_match_fields(report, types):
+    if report == 'domain':
+        return ['DEST']
+    if report == 'url':
+        return ['url']
+    if report == 'email':
+        return ['src_user']
+    if report == 'hash':
+        return ['file_hash', 'process_hash']
+    # ip: each rule prepends its fields, duplicates are removed afterwards
+    cim_match_fields = []
+    if any('domain' in misp_type for misp_type in types):
+        cim_match_fields = ['SRC', 'DEST'] + cim_match_fields
+    if any('ip-src' in misp_type for misp_type in types):
+        cim_match_fields = ['DEST'] + cim_match_fields
+    if any('ip-dst' in misp_type for misp_type in types):
+        cim_match_fields = ['SRC'] + cim_match_fields
+    return list(dict.fromkeys(cim_match_fields))
+
+
+def _values(value):
+    if value is None or value == '':
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _is_true(value):
+    return value is True or str(value).lower() in ('true', '1')
+
+
+def _format_number(value):
+    return str(int(value)) if value == int(value) else str(value)
+
+
+def get_attribute_entry(record):
+    # the aggregated fields of a mapped attribute
+    return [
+        int(record['misp_timestamp']),
+        record.get('misp_category'),
+        record.get('misp_event_id'),
+        record.get('misp_orgc_id'),
+        list(_values(record.get('misp_tag'))),
+        record.get('misp_type'),
+        record.get('misp_event_info'),
+    ]
+
+
+def is_exported(record):
+    return _is_true(record.get('misp_to_ids')) and not _is_true(record.get('misp_deleted'))
+
+
+def get_weight(attributes, scorer):
+    """
+    Weight of a value like the MISP_TI_* reports: the max org score of its attributes, else
+    the max tag score, else the max generic score. None if no attribute has a score.
+    """
+    org_score = tag_score = generic_score = None
+    for attribute in attributes:
+        scores = scorer.get_scores(attribute[TIMESTAMP], attribute[TAGS], _values(attribute[ORG_ID]))
+        if scores[0] is not None and (org_score is None or scores[0] > org_score):
+            org_score = scores[0]
+        if scores[1] is not None and (tag_score is None or scores[1] > tag_score):
+            tag_score = scores[1]
+        if scores[2] is not None and (generic_score is None or scores[2] > generic_score):
+            generic_score = scores[2]
+    return org_score if org_score is not None else tag_score if tag_score is not None else generic_score
+
+
+def get_description(report, attributes):
+    categories, event_ids, org_ids, tags, types, events = set(), set(), set(), set(), set(), set()
+    for attribute in attributes:
+        categories.update(_values(attribute[CATEGORY]))
+        event_ids.update(str(event_id) for event_id in _values(attribute[EVENT_ID]))
+        org_ids.update(str(org_id) for org_id in _values(attribute[ORG_ID]))
+        tags.update(attribute[TAGS])
+        types.update(_values(attribute[TYPE]))
+        events.update(_values(attribute[EVENT_INFO]))
+    # the values are sorted like the values() of stats
+    return _encoder.encode({
+        'misp_categories': sorted(categories),
+        'misp_event_ids': sorted(event_ids),
+        'misp_org_ids': sorted(org_ids),
+        'misp_tags': sorted(tags),
+        'misp_types': sorted(types),
+        'cim_match_fields': get_cim_match_fields(report, types),
+        'events': sorted(events),
+    })
+
+
+def lookup_row(report, value, description, weight):
+    row = dict.fromkeys(LOOKUP_FIELDS, '')
+    row['report'] = report
+    row['description'] = description
+    row[REPORTS[report]['column']] = value
+    row['weight'] = _format_number(weight)
+    return row
+
+
+class TIAggregator:
+    """
+    Aggregates MISP attributes (mapped with the misp_ prefix, like the indexed attribute events)
+    into the rows of the TI lookups, like the stats of the MISP_TI_* reports do.
+
+    The attributes are kept per report and value by an attribute key, so attributes with
+    expanded tags (one event per tag) are merged. The weights are computed from the kept
+    attributes when the rows are returned, so they decay with the age of the attributes.
+    """
+    def __init__(self, reports=REPORTS):
+        self.reports = reports
+        # report -> value -> attribute key -> [timestamp, category, event id, org id, tags, type, event info]
+        self.entries = {report: {} for report in reports}
+
+    def add(self, attribute_key, record, reports=None):
+        """
+        Adds a mapped attribute to the reports (all if None)
+        """
+        if not is_exported(record):
+            return
+        entry = get_attribute_entry(record)
+        for report in reports if reports is not None else self.reports:
+            value = record.get(self.reports[report]['field'])
+            if not value:
+                continue
+            attributes = self.entries[report].setdefault(value, {})
+            attribute = attributes.get(attribute_key)
+            if attribute is None or attribute[TIMESTAMP] < entry[TIMESTAMP]:
+                attributes[attribute_key] = entry
+            elif attribute[TIMESTAMP] == entry[TIMESTAMP]:
+                attribute[TAGS].extend(tag for tag in entry[TAGS] if tag not in attribute[TAGS])
+
+    def iter_lookup_rows(self, now, decay_settings, decay_scores_path=DECAY_SCORES_PATH):
+        """
+        Yields the lookup rows of all reports with a weight above 0, sorted by value per report,
+        decay_settings are the decaying settings of the app
+        """
+        for report in self.reports:
+            scorer = DecayScorer.from_settings(decay_settings, report, path=decay_scores_path, now=now)
+            entries = self.entries[report]
+            for value in sorted(entries):
+                attributes = entries[value].values()
+                weight = get_weight(attributes, scorer)
+                if weight is None or weight <= 0:
+                    continue
+                yield lookup_row(report, value, get_description(report, attributes), weight)
+
+    def get_stats(self):
+        return {report: sum(len(attributes) for attributes in entries.values()) for report, entries in self.entries.items()}
+
+
+TI_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS seqs (
+    instance TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    report TEXT NOT NULL,
+    value TEXT NOT NULL,
+    attribute_key TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (report, value, attribute_key)
+);
+CREATE INDEX IF NOT EXISTS entries_attribute_key ON entries (attribute_key);
+CREATE INDEX IF NOT EXISTS entries_timestamp ON entries (report, timestamp);
+CREATE TABLE IF NOT EXISTS descriptions (
+    report TEXT NOT NULL,
+    value TEXT NOT NULL,
+    description TEXT NOT NULL,
+    PRIMARY KEY (report, value)
+);
+'''
+
+
+class IncrementalTIBuilder:
+    """
+    Maintains the aggregated attributes of the TI lookups from the local IOC stores of MISP
+    instances in a SQLite database. The IOC store seq is the checkpoint: each build only reads
+    the attributes which the indicator inputs added or replaced since the last build and updates
+    their entries, expired entries are deleted. The descriptions of values are kept until the
+    attributes of the value change, the weights are computed when the rows are returned, so they
+    decay with the age of the attributes.
+    """
+    def __init__(self, path, reports=REPORTS):
+        self.path = path
+        self.reports = reports
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(TI_SCHEMA)
+
+    @classmethod
+    def for_state_dir(cls, state_dir):
+        return cls(os.path.join(state_dir, 'ti_export', 'state.db'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def remove(self, attribute_key_condition, parameters):
+        # deletes the entries of the matching attribute keys and the descriptions of their values
+        self.connection.execute(
+            'DELETE FROM descriptions WHERE (report, value) IN '
+            f'(SELECT report, value FROM entries WHERE {attribute_key_condition})',
+            parameters
+        )
+        self.connection.execute(f'DELETE FROM entries WHERE {attribute_key_condition}', parameters)
+
+    def update(self, instance, ioc_store):
+        """
+        Updates the entries of the attributes of the store which were added since the last build
+        of the instance, returns the amount of updated attributes
+        """
+        # only needed on the search head
+        from misp_client import MISPHTTPClient
+
+        mapper = MISPHTTPClient.get_attribute_mapper('misp_')
+        row = self.connection.execute('SELECT seq FROM seqs WHERE instance = ?', (instance,)).fetchone()
+        seq = row[0] if row else 0
+        count = 0
+        with self.connection:
+            if ioc_store.get_stats()['ioc_store_seq'] < seq:
+                # the store was recreated, its attributes are added again
+                prefix = f'{instance}:'
+                self.remove('substr(attribute_key, 1, ?) = ?', (len(prefix), prefix))
+                seq = 0
+            for seq, attribute in ioc_store.iter_since(seq):
+                attribute_key = f"{instance}:{attribute['id']}"
+                self.remove('attribute_key = ?', (attribute_key,))
+                record = mapper.map(attribute)
+                count += 1
+                if not is_exported(record):
+                    continue
+                entry = get_attribute_entry(record)
+                data = _encoder.encode(entry)
+                for report, definition in self.reports.items():
+                    value = record.get(definition['field'])
+                    if value:
+                        self.connection.execute('DELETE FROM descriptions WHERE report = ? AND value = ?', (report, value))
+                        self.connection.execute(
+                            'INSERT OR REPLACE INTO entries (report, value, attribute_key, timestamp, data) VALUES (?, ?, ?, ?, ?)',
+                            (report, value, attribute_key, entry[TIMESTAMP], data)
+                        )
+            self.connection.execute('INSERT OR REPLACE INTO seqs (instance, seq) VALUES (?, ?)', (instance, seq))
+        return count
+
+    def expire(self, now):
+        """
+        Deletes the entries which are older than the period of their report, returns their amount
+        """
+        expired_count = 0
+        with self.connection:
+            for report, definition in self.reports.items():
+                earliest = now - definition['period_days'] * SECONDS_PER_DAY
+                self.connection.execute(
+                    'DELETE FROM descriptions WHERE report = ? AND value IN '
+                    '(SELECT value FROM entries WHERE report = ? AND timestamp < ?)',
+                    (report, report, earliest)
+                )
+                expired_count += self.connection.execute('DELETE FROM entries WHERE report = ? AND timestamp < ?', (report, earliest)).rowcount
+        return expired_count
+
+    def iter_lookup_rows(self, now, decay_settings, decay_scores_path=DECAY_SCORES_PATH):
+        """
+        Yields the lookup rows of all reports with a weight above 0, sorted by value per report,
+        decay_settings are the decaying settings of the app. Missing descriptions are stored once
+        all rows are returned.
+        """
+        new_descriptions = []
+        for report in self.reports:
+            scorer = DecayScorer.from_settings(decay_settings, report, path=decay_scores_path, now=now)
+            descriptions = dict(self.connection.execute('SELECT value, description FROM descriptions WHERE report = ?', (report,)))
+            cursor = self.connection.execute('SELECT value, data FROM entries WHERE report = ? ORDER BY value', (report,))
+            for value, rows in groupby(cursor, key=lambda row: row[0]):
+                attributes = [json.loads(data) for _, data in rows]
+                weight = get_weight(attributes, scorer)
+                if weight is None or weight <= 0:
+                    continue
+                description = descriptions.get(value)
+                if description is None:
+                    description = get_description(report, attributes)
+                    new_descriptions.append((report, value, description))
+                yield lookup_row(report, value, description, weight)
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO descriptions (report, value, description) VALUES (?, ?, ?)', new_descriptions)
+
+    def build(self, ioc_stores, now):
+        """
+        Updates the entries from the IOC stores by instance name and deletes expired ones, returns the stats
+        """
+        stats = {'attributes_merged': {instance: self.update(instance, ioc_store) for instance, ioc_store in ioc_stores.items()}}
+        stats['attributes_expired'] = self.expire(now)
+        stats['attributes'] = self.get_stats()
+        return stats
+
+    def get_stats(self):
+        counts = dict(self.connection.execute('SELECT report, COUNT(*) FROM entries GROUP BY report'))
+        return {report: counts.get(report, 0) for report in self.reports}
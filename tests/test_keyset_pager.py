@@ -0,0 +1,59 @@
+import os
+import sys
+from types import ModuleType
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'package', 'bin'))
+# generated by ucc-gen, only extends sys.path in the built app
+sys.modules.setdefault('import_declare_test', ModuleType('import_declare_test'))
+
+from misp_client import KeysetPager, PageSizer
+
+
+class FakeMISPClient:
+    """
+    Serves attributes ordered by timestamp like /attributes/restSearch, attributes_per_timestamp
+    attributes share a timestamp. Every page takes response_seconds, so an adaptive page sizer
+    with a lower target shrinks the limit to its minimum.
+    """
+    def __init__(self, attribute_count, attributes_per_timestamp, response_seconds=1.0):
+        self.attributes = [
+            {'id': str(index + 1), 'timestamp': str(1000 + index // attributes_per_timestamp)}
+            for index in range(attribute_count)
+        ]
+        self.response_seconds = response_seconds
+        self.request_count = 0
+
+    def get_attributes(self, limit, page, timestamp=None, order=None, raw_items=False, **kwargs):
+        self.request_count += 1
+        attributes = [attribute for attribute in self.attributes if int(attribute['timestamp']) >= timestamp]
+        attributes = attributes[(page - 1) * limit:page * limit]
+        return {
+            'response': {'Attribute': attributes},
+            'headers': {'X-Skipped-Elements-Count': '0'},
+            'response_stats': {'seconds': self.response_seconds, 'bytes': 100 * len(attributes)}
+        }
+
+
+def fetch_ids(client, page_sizer):
+    ids = []
+    for result in KeysetPager(client, page_sizer.limit, page_sizer=page_sizer):
+        ids.extend(attribute['id'] for attribute in result['response']['Attribute'])
+    return ids
+
+
+def test_adaptive_page_size_within_timestamp():
+    client = FakeMISPClient(6000, 100)
+    page_sizer = PageSizer(1000, 10, 10000, target_seconds=0.01, aligned=False)
+    ids = fetch_ids(client, page_sizer)
+    assert ids == [attribute['id'] for attribute in client.attributes]
+    assert page_sizer.limit == 10
+    # about one request per timestamp, not one per min limit within each timestamp
+    assert client.request_count <= 2 * 6000 // 100
+
+
+def test_fixed_page_size():
+    client = FakeMISPClient(6000, 100)
+    page_sizer = PageSizer(1000, 1000, 1000)
+    ids = fetch_ids(client, page_sizer)
+    assert ids == [attribute['id'] for attribute in client.attributes]
+    assert client.request_count <= 8